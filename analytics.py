@@ -0,0 +1,199 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from schema import ORDINAL_COLUMNS
+
+# Side effects followed over time, graded on the scales in schema.ORDINAL_COLUMNS
+TOXICITY_COLUMNS = [column for column in ORDINAL_COLUMNS if column != "Grade"]
+
+# Events recorded at follow-up and the column holding the months to each event
+EVENT_COLUMNS = {
+    "Local_recurrence": "Time_to_local_recurrence",
+    "Regional_recurrence": "Time_to_regional_recurrence",
+    "Distant_recurrence": "Time_to_distant_recurrence",
+    "Death": "Time_to_death",
+}
+
+
+# Vectorized calculate_months over two date columns
+def months_between(start, end):
+    start = pd.to_datetime(start, errors="coerce")
+    end = pd.to_datetime(end, errors="coerce")
+    return (end.dt.year - start.dt.year) * 12 + (end.dt.month - start.dt.month)
+
+
+# Numeric grade of an ordinal column: 0 for the first option ("None"), missing
+# for values outside the scale
+def grade_codes(series, scale):
+    codes = pd.Categorical(series.astype(object), categories=scale, ordered=True).codes
+    codes = pd.Series(codes, index=series.index, dtype=float)
+    return codes.where(codes >= 0)
+
+
+# Months to an event; the form saves the time to death as "time_to_death"
+def event_times(visits, event):
+    times = pd.to_numeric(visits[EVENT_COLUMNS[event]], errors="coerce")
+    if event == "Death" and "time_to_death" in visits:
+        times = times.fillna(pd.to_numeric(visits["time_to_death"], errors="coerce"))
+    return times
+
+
+# Toxicity grades of each visit against months since the last radiotherapy
+def patient_timeline(visits):
+    timeline = pd.DataFrame(index=visits.index)
+    timeline["Follow-up date"] = visits["Follow_up_date"]
+    timeline["Months since radiotherapy"] = months_between(visits["Date_of_Last_Radiotherapy"], visits["Follow_up_date"])
+    for column in TOXICITY_COLUMNS:
+        timeline[column] = grade_codes(visits[column], ORDINAL_COLUMNS[column])
+    return timeline
+
+
+# First visit at which each recurrence or death was recorded
+def recurrence_events(visits):
+    events = []
+    for event in EVENT_COLUMNS:
+        recorded = visits[visits[event].astype(object) == "Yes"]
+        if not len(recorded):
+            continue
+        first = recorded.index[0]
+        events.append({
+            "Event": event.replace("_", " ").capitalize(),
+            "Recorded at follow-up": recorded.at[first, "Follow_up_date"],
+            "Months since radiotherapy": event_times(recorded, event).loc[first],
+        })
+    return pd.DataFrame(events, columns=["Event", "Recorded at follow-up", "Months since radiotherapy"])
+
+
+# Months of follow-up of each visit, falling back to the visit dates
+def follow_up_months(df):
+    months = pd.to_numeric(df["Follow_up_time"], errors="coerce")
+    return months.fillna(months_between(df["Date_of_Last_Radiotherapy"], df["Follow_up_date"]))
+
+
+# One row per patient: fractionation of the latest visit, worst grade of every
+# side effect, and for every event whether it occurred and the months to the
+# event or to the last follow-up (censored)
+def patient_outcomes(df):
+    df = df.sort_values("Follow_up_date", kind="stable")
+    visits = pd.DataFrame({"MRN": df["MRN"], "Follow_up_months": follow_up_months(df)})
+    for column in TOXICITY_COLUMNS:
+        visits[column] = grade_codes(df[column], ORDINAL_COLUMNS[column])
+    for event in EVENT_COLUMNS:
+        occurred = df[event].astype(object) == "Yes"
+        visits[event] = occurred
+        visits[event + "_months"] = event_times(df, event).where(occurred)
+
+    grouped = visits.groupby("MRN", sort=False)
+    outcomes = grouped[TOXICITY_COLUMNS].max()
+    # Schedule of each patient's last visit, taken by position: groupby's last()
+    # runs in Python on the Arrow list column
+    last = np.flatnonzero(~df["MRN"].duplicated(keep="last").to_numpy())
+    outcomes["Fractionation"] = pd.Series(df["Fractionation"].take(last).array, index=df["MRN"].take(last).to_numpy())
+    last_follow_up = grouped["Follow_up_months"].max()
+    for event in EVENT_COLUMNS:
+        outcomes[event] = grouped[event].any()
+        months = grouped[event + "_months"].min()
+        outcomes[event + "_months"] = months.where(outcomes[event], last_follow_up)
+    return outcomes
+
+
+# Share of patients with each worst grade of a side effect, per fractionation
+# schedule; a patient treated with several schedules counts for each of them
+def grade_distribution(outcomes, column):
+    scale = ORDINAL_COLUMNS[column]
+    patients = outcomes[["Fractionation", column]].explode("Fractionation").dropna()
+    if not len(patients):
+        return pd.DataFrame(columns=scale)
+    grades = pd.Categorical.from_codes(patients[column].astype(int), scale)
+    table = pd.crosstab(patients["Fractionation"].astype(str), grades, normalize="index", dropna=False) * 100
+    table = table.reindex(columns=scale, fill_value=0).rename_axis(columns=None)
+    table.insert(0, "Patients", patients.groupby("Fractionation").size())
+    return table
+
+
+# Kaplan-Meier estimate; returns the distinct event times (starting at 0) and
+# the survival probability from each of them until the next one
+def kaplan_meier(time, event):
+    time = np.asarray(time, dtype=float)
+    event = np.asarray(event, dtype=bool)
+    known = ~np.isnan(time)
+    order = np.argsort(time[known], kind="stable")
+    time, event = time[known][order], event[known][order]
+    event_times, deaths = np.unique(time[event], return_counts=True)
+    at_risk = len(time) - np.searchsorted(time, event_times, side="left")
+    survival = np.cumprod(1 - deaths / at_risk)
+    return np.concatenate([[0.0], event_times]), np.concatenate([[1.0], survival])
+
+
+# Survival of a Kaplan-Meier step function at the given times
+def survival_at(km_times, km_survival, times):
+    return km_survival[np.searchsorted(km_times, times, side="right") - 1]
+
+
+# Survival curves of `replicates` bootstrap resamples of the patients,
+# evaluated on `grid`; run in worker processes
+def bootstrap_curves(time, event, grid, replicates, seed):
+    rng = np.random.default_rng(seed)
+    curves = np.empty((replicates, len(grid)))
+    for replicate in range(replicates):
+        sample = rng.integers(0, len(time), len(time))
+        km_times, km_survival = kaplan_meier(time[sample], event[sample])
+        curves[replicate] = survival_at(km_times, km_survival, grid)
+    return curves
+
+
+bootstrap_pool = None
+bootstrap_pool_lock = threading.Lock()
+
+
+# One process pool per server, created on first use. Its workers are spawned
+# rather than forked: forking the server while its other threads (tornado,
+# the registry writer, the metrics exporter) run can deadlock the child.
+def get_bootstrap_pool():
+    global bootstrap_pool
+    with bootstrap_pool_lock:
+        if bootstrap_pool is None:
+            bootstrap_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return bootstrap_pool
+
+
+# Kaplan-Meier curve with a percentile bootstrap confidence interval. The
+# resamples are split over the process pool, one seeded chunk per worker.
+def survival_curve(time, event, replicates=200, confidence=0.95, workers=None, seed=0):
+    time = np.asarray(time, dtype=float)
+    event = np.asarray(event, dtype=bool)
+    known = ~np.isnan(time)
+    time, event = time[known], event[known]
+    km_times, km_survival = kaplan_meier(time, event)
+    curve = pd.DataFrame({"Months": km_times, "Survival": km_survival})
+    if not len(time) or not replicates:
+        curve["Lower"] = curve["Upper"] = np.nan
+        return curve
+
+    workers = min(workers or os.cpu_count() or 1, replicates)
+    chunks = [len(chunk) for chunk in np.array_split(np.arange(replicates), workers)]
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    if workers > 1:
+        results = get_bootstrap_pool().map(bootstrap_curves, [time] * workers, [event] * workers,
+                                           [km_times] * workers, chunks, seeds)
+        curves = np.vstack(list(results))
+    else:
+        curves = bootstrap_curves(time, event, km_times, replicates, seeds[0])
+    alpha = (1 - confidence) / 2
+    curve["Lower"] = np.quantile(curves, alpha, axis=0)
+    curve["Upper"] = np.quantile(curves, 1 - alpha, axis=0)
+    return curve
+
+
+# Number of patients, events and survival at a few landmark times
+def survival_summary(curve, outcomes, event, landmarks=(12, 24, 60)):
+    summary = {"Patients": int(outcomes[event + "_months"].notna().sum()), "Events": int(outcomes[event].sum())}
+    for months in landmarks:
+        summary[f"{months} months"] = float(survival_at(curve["Months"].to_numpy(), curve["Survival"].to_numpy(), months))
+    return summary
@@ -0,0 +1,131 @@
+from functools import partial
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+from schema import DATE_COLUMNS
+
+# Date the form falls back to when a stored date cannot be read
+DEFAULT_DATE = pd.Timestamp("1900-01-01")
+# Columns compared with the patient's previous visit
+PREVIOUS_COLUMNS = ["LVI", "PR", "Volume - Left Breast", "Volume - Right Breast"]
+
+
+def follow_up_before_radiotherapy(visits, previous):
+    return visits["Follow_up_date"] < visits["Date_of_Last_Radiotherapy"]
+
+
+def default_date(column, visits, previous):
+    return visits[column] == DEFAULT_DATE
+
+
+# The form prefills LVI with the previous visit's PR result
+def lvi_from_pr(visits, previous):
+    lvi = visits["LVI"]
+    # Categoricals compare by their codes once they share the categories
+    pr = previous["PR"].cat.set_categories(lvi.cat.categories)
+    return previous["LVI"].notna() & (lvi != previous["LVI"]) & (lvi == pr)
+
+
+# The form prefills the volumes from "Volume_left" and "Volume_right", which are
+# never saved, so a follow-up falls back to "Whole Breast"
+def volume_reset(column, visits, previous):
+    before = previous[column]
+    return (visits[column] == "Whole Breast") & before.notna() & (before != "Whole Breast")
+
+
+# A value saved under a key that is not the registry column, with the column empty
+def misnamed(column, saved_as, visits, previous):
+    if saved_as not in visits:
+        return np.zeros(len(visits), dtype=bool)
+    value = visits[saved_as].astype(object)
+    return value.notna() & (value != "N/A") & visits[column].isna()
+
+
+# Every rule is evaluated on all the checked visits at once. `visits` holds the
+# visits and `previous` the same patient's visit before each of them (missing
+# for a first visit); a rule returns a boolean mask of the visits it flags.
+RULES = [
+    ("Follow-up before radiotherapy", "Follow-up date is before the date of last radiotherapy",
+     follow_up_before_radiotherapy),
+    *[(f"Default {column}", f"{column} is the 1900-01-01 default", partial(default_date, column))
+      for column in DATE_COLUMNS],
+    ("LVI copied from PR", "LVI changed since the previous visit to the previous PR result", lvi_from_pr),
+    *[(f"{column} reset", f"{column} changed since the previous visit to the form's 'Whole Breast' default",
+       partial(volume_reset, column)) for column in ["Volume - Left Breast", "Volume - Right Breast"]],
+    ("Time_to_death saved as time_to_death", "Time_to_death is empty and the value was saved as 'time_to_death'",
+     partial(misnamed, "Time_to_death", "time_to_death")),
+]
+
+ISSUE_COLUMNS = ["Row", "MRN", "Follow_up_date", "Rule", "Issue"]
+
+
+# Position (within `visits`) of each visit's previous visit of the same patient, -1 for a first visit
+def previous_positions(visits):
+    codes = pd.factorize(visits["MRN"])[0]
+    # One sort key per visit: the patient in the high bits, then days since
+    # 1800 with missing dates first
+    days = visits["Follow_up_date"].to_numpy(dtype="datetime64[D]")
+    since = np.where(np.isnat(days), 0, np.maximum((days - np.datetime64("1800-01-01")).astype(np.int64) + 1, 1))
+    order = np.argsort((codes.astype(np.int64) << 32) | since, kind="stable")
+    previous = np.full(len(visits), -1)
+    same_patient = codes[order[1:]] == codes[order[:-1]]
+    previous[order[1:]] = np.where(same_patient, order[:-1], -1)
+    return previous
+
+
+# Run every rule over the visits at rows `rows` of the registry (None for all of
+# them); the rows must hold every visit of the patients they include
+def check(df, rows=None):
+    visits = df if rows is None else df.iloc[rows]
+    rows = np.arange(len(df)) if rows is None else np.asarray(rows)
+    positions = previous_positions(visits)
+    previous = visits[PREVIOUS_COLUMNS].iloc[np.maximum(positions, 0)]
+    previous.index = visits.index
+    previous = previous.where(pd.Series(positions >= 0, index=visits.index), axis=0)
+
+    issues = []
+    for rule, description, flags in RULES:
+        flagged = np.flatnonzero(np.asarray(flags(visits, previous), dtype=bool))
+        if len(flagged):
+            issues.append(pd.DataFrame({
+                "Row": rows[flagged],
+                "MRN": visits["MRN"].to_numpy()[flagged],
+                "Follow_up_date": visits["Follow_up_date"].to_numpy()[flagged],
+                "Rule": rule,
+                "Issue": description,
+            }))
+    if not issues:
+        return pd.DataFrame(columns=ISSUE_COLUMNS)
+    return pd.concat(issues, ignore_index=True)
+
+
+# Data-quality issues of the registry, kept between audits. Rows are only ever
+# appended, so after the first audit only the patients with new visits are
+# checked again (a new visit can change which visit comes before another).
+class Audit:
+    def __init__(self):
+        self.generation = None
+        self.checked = 0
+        self.issues = pd.DataFrame(columns=ISSUE_COLUMNS)
+
+    def run(self, df, generation, mrn_index):
+        if generation != self.generation or len(df) < self.checked:
+            self.issues = check(df)
+        elif len(df) > self.checked:
+            mrns = set(df["MRN"].iloc[self.checked:])
+            rows = sorted(chain.from_iterable((position for _, position in mrn_index[mrn]) for mrn in mrns))
+            kept = self.issues[~self.issues["MRN"].isin(mrns)]
+            self.issues = pd.concat([kept, check(df, rows)], ignore_index=True) if len(kept) else check(df, rows)
+        self.generation = generation
+        self.checked = len(df)
+        return self.issues
+
+
+# One row per patient with issues: how many visits are affected and by what
+def issues_by_patient(issues):
+    return issues.groupby("MRN", sort=True).agg(
+        Visits=("Row", "nunique"),
+        Issues=("Rule", lambda rules: ", ".join(sorted(set(rules)))),
+    ).reset_index()
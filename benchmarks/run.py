@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import metrics
+import registry
+from benchmarks.synthetic import generate_registry, write_registry
+from registry import Registry, get_patient_data, load_data, safe_get_list, save_data
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "streamlit_app.py")
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+
+# Latency percentiles, throughput and peak Python memory of calling `operation`
+# `repeat` times. Memory is traced on one extra call so tracing does not skew
+# the timings; Arrow buffers allocated outside Python are not included.
+def measure(operation, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operation()
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    operation()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    durations = np.array(durations) * 1000
+    return {
+        "calls": repeat,
+        "p50_ms": round(float(np.percentile(durations, 50)), 3),
+        "p95_ms": round(float(np.percentile(durations, 95)), 3),
+        "ops_per_s": round(float(repeat / durations.sum() * 1000), 1),
+        "peak_mb": round(peak / 2 ** 20, 2),
+    }
+
+
+# Point the app's registry at the synthetic files and start from a cold cache
+def use_registry(directory):
+    registry.registry_log = os.path.join(directory, "Breast_clinic.jsonl")
+    registry.registry_snapshot = os.path.join(directory, "Breast_clinic_parquet")
+    registry.excel_file = os.path.join(directory, "Breast_clinic.xlsx")
+    registry.write_behind = False
+    # Leave the server's metrics file alone
+    metrics.metrics_file = None
+    registry.get_registry.clear()
+
+
+# Run the benchmarks on a synthetic registry of `rows` rows in a temporary
+# directory, which is removed afterwards
+def run_benchmarks(rows, lookups=1000, saves=100, reruns=10, seed=0):
+    with tempfile.TemporaryDirectory(prefix="breast_bench_") as directory:
+        try:
+            return benchmark_registry(directory, rows, lookups, saves, reruns, seed)
+        finally:
+            # Drop the app's cached registry of the files about to be removed
+            registry.get_registry.clear()
+
+
+def benchmark_registry(directory, rows, lookups, saves, reruns, seed):
+    random.seed(seed)
+    results = {}
+    df = generate_registry(rows, seed=seed)
+    write_registry(df, directory)
+    use_registry(directory)
+    loads = 3 if rows <= 100000 else 1
+
+    results["load_log"] = measure(lambda: Registry(registry.registry_log, registry.excel_file).frame(), loads)
+    Registry(registry.registry_log, registry.excel_file, None, registry.registry_snapshot).compact()
+    results["load_snapshot"] = measure(
+        lambda: Registry(registry.registry_log, registry.excel_file, None, registry.registry_snapshot).frame(), loads
+    )
+
+    # A scheduled extract of one radiotherapy year, read from its partition only
+    results["read_one_year"] = measure(lambda: registry.read_registry("2020-01-01", "2020-12-31"), loads)
+
+    # What every rerun of the page pays once the registry is cached
+    load_data()
+    results["load_data_cached"] = measure(load_data, lookups)
+
+    mrns = df["MRN"].unique().tolist()
+    results["get_patient_data"] = measure(lambda: get_patient_data(random.choice(mrns)), lookups)
+
+    record = {key: value for key, value in df.iloc[0].to_dict().items() if not isinstance(value, float)}
+    results["save_data"] = measure(lambda: save_data(dict(record, MRN=random.choice(mrns))), saves)
+
+    legacy = [{"Histology": str(value)} for value in df["Histology"].head(1000)]
+    results["safe_get_list_x1000"] = measure(lambda: [safe_get_list(row, "Histology") for row in legacy], 20)
+
+    from streamlit.testing.v1 import AppTest
+    app = AppTest.from_file(APP, default_timeout=120)
+    app.run()
+    results["app_rerun"] = measure(lambda: app.text_input(key="mrn").input(random.choice(mrns)).run(), reruns)
+    return results
+
+
+# Benchmarks whose p95 latency grew by more than `tolerance` times the baseline;
+# sub-millisecond jitter below `min_delta_ms` is ignored
+def regressions(results, baseline, tolerance, min_delta_ms):
+    slower = {}
+    for name, result in results.items():
+        expected = baseline["benchmarks"].get(name)
+        if not expected:
+            continue
+        limit = max(expected["p95_ms"] * tolerance, expected["p95_ms"] + min_delta_ms)
+        if result["p95_ms"] > limit:
+            slower[name] = (expected["p95_ms"], result["p95_ms"])
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the registry's load, lookup, save and rerun paths on synthetic data.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000], help="registry sizes to benchmark")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results in benchmarks/baselines")
+    parser.add_argument("--compare", action="store_true", help="fail if any p95 regressed against the stored baseline")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed p95 slowdown factor for --compare")
+    parser.add_argument("--min-delta-ms", type=float, default=2.0, help="ignore p95 slowdowns smaller than this")
+    args = parser.parse_args()
+
+    report = {"python": platform.python_version(), "machine": platform.machine(), "runs": {}}
+    failed = False
+    for rows in args.rows:
+        results = run_benchmarks(rows)
+        report["runs"][str(rows)] = results
+        print(f"\n{rows} rows")
+        print(f"{'benchmark':<22}{'p50 ms':>12}{'p95 ms':>12}{'ops/s':>12}{'peak MB':>10}")
+        for name, result in results.items():
+            print(f"{name:<22}{result['p50_ms']:>12}{result['p95_ms']:>12}{result['ops_per_s']:>12}{result['peak_mb']:>10}")
+
+        baseline_path = os.path.join(BASELINES, f"{rows}.json")
+        if args.compare and os.path.exists(baseline_path):
+            with open(baseline_path) as f:
+                slower = regressions(results, json.load(f), args.tolerance, args.min_delta_ms)
+            for name, (expected, actual) in slower.items():
+                print(f"REGRESSION {name}: p95 {actual} ms, baseline {expected} ms")
+            failed = failed or bool(slower)
+        if args.save_baseline:
+            os.makedirs(BASELINES, exist_ok=True)
+            with open(baseline_path, "w") as f:
+                json.dump({"python": report["python"], "machine": report["machine"], "benchmarks": results}, f, indent=2)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
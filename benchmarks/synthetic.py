@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from schema import CHOICE_COLUMNS, COLUMNS, LIST_OPTIONS, ORDINAL_COLUMNS
+from storage import RowLog, new_entry
+
+# Share of patients with each event, and how much milder grades are than the next
+EVENT_RATES = {"Local_recurrence": 0.03, "Regional_recurrence": 0.02, "Distant_recurrence": 0.05, "Death": 0.04}
+GRADE_DECAY = 0.35
+
+
+def dates_to_strings(days):
+    return np.datetime_as_string(days.astype("datetime64[D]"), unit="D")
+
+
+# Pick one or two options for every row, as the multiselects usually hold
+def random_lists(rng, options, rows):
+    first = rng.integers(0, len(options), rows)
+    second = rng.integers(0, len(options), rows)
+    two = rng.random(rows) < 0.3
+    return [[options[a], options[b]] if pair and a != b else [options[a]] for a, b, pair in zip(first, second, two)]
+
+
+# Grades skewed towards "None", the way toxicity is distributed in clinic
+def random_grades(rng, scale, rows):
+    weights = GRADE_DECAY ** np.arange(len(scale))
+    return np.asarray(scale, dtype=object)[rng.choice(len(scale), rows, p=weights / weights.sum())]
+
+
+# Synthetic registry of `rows` follow-up visits with the registry columns and the
+# options offered by the form; patients have one to six visits six months apart
+def generate_registry(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    visits_per_patient = rng.integers(1, 7, rows)
+    patient = np.repeat(np.arange(rows), visits_per_patient)[:rows]
+    visit = np.concatenate([np.arange(count) for count in visits_per_patient])[:rows]
+    patients = patient.max() + 1
+
+    birth = np.datetime64("1940-01-01") + rng.integers(0, 45 * 365, patients)
+    radiotherapy = np.datetime64("2015-01-01") + rng.integers(0, 10 * 365, patients)
+    surgery = radiotherapy - rng.integers(30, 120, patients)
+    follow_up = radiotherapy[patient] + visit * 182 + rng.integers(0, 60, rows)
+
+    df = pd.DataFrame({"MRN": [f"{100000 + p}" for p in patient]})
+    df["Date_of_Birth"] = dates_to_strings(birth[patient])
+    df["Age"] = ((radiotherapy - birth) // 365).astype(int)[patient]
+    df["Date_of_Last_Radiotherapy"] = dates_to_strings(radiotherapy[patient])
+    df["Follow_up_date"] = dates_to_strings(follow_up)
+    df["Follow_up_time"] = ((follow_up - radiotherapy[patient]) // 30).astype(int)
+    df["Surgery_date"] = dates_to_strings(surgery[patient])
+
+    # Treatment and tumour details belong to the patient, not the visit
+    for column, options in LIST_OPTIONS.items():
+        if "Recurrence" not in column:
+            lists = random_lists(rng, options, patients)
+            df[column] = [lists[p] for p in patient]
+    for column, options in CHOICE_COLUMNS.items():
+        if column not in EVENT_RATES and column != "Cancer Related Death":
+            df[column] = np.asarray(options, dtype=object)[rng.integers(0, len(options), patients)][patient]
+    for column, scale in ORDINAL_COLUMNS.items():
+        df[column] = random_grades(rng, scale, rows)
+
+    for event, rate in EVENT_RATES.items():
+        occurred = (rng.random(patients) < rate)[patient] & (visit > 0)
+        df[event] = np.where(occurred, "Yes", "No")
+        time_column = "Time_to_death" if event == "Death" else "Time_to_" + event.lower()
+        df[time_column] = np.where(occurred, df["Follow_up_time"] - rng.integers(0, 6, rows), "N/A")
+        definition = event.replace("_recurrence", " Recurrence Definition")
+        if definition in LIST_OPTIONS:
+            options = random_lists(rng, LIST_OPTIONS[definition], rows)
+            df[definition] = [value if happened else "N/A" for value, happened in zip(options, occurred)]
+    df["Cancer Related Death"] = np.where(df["Death"] == "Yes", "Yes", "N/A")
+    return df.reindex(columns=COLUMNS)
+
+
+# Write a synthetic registry as the append-only log the app reads
+def write_registry(df, directory, chunksize=50000):
+    os.makedirs(directory, exist_ok=True)
+    log = RowLog(os.path.join(directory, "Breast_clinic.jsonl"))
+    for start in range(0, len(df), chunksize):
+        chunk = df.iloc[start:start + chunksize]
+        log.append([new_entry({key: value for key, value in row.items() if not is_missing(value)})
+                    for row in chunk.to_dict("records")])
+    return log.path
+
+
+def is_missing(value):
+    return not isinstance(value, list) and pd.isna(value)
@@ -0,0 +1,127 @@
+import tempfile
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from schema import LIST_DTYPE
+
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/octet-stream"),
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+
+
+# Rows whose list column holds any of `values`, without expanding the lists
+def list_contains_any(series, values):
+    lists = pa.array(series)
+    hits = pc.is_in(pc.list_flatten(lists), value_set=pa.array(values, type=pa.string()))
+    mask = np.zeros(len(series), dtype=bool)
+    mask[np.asarray(pc.list_parent_indices(lists))[np.asarray(hits, dtype=bool)]] = True
+    return mask
+
+
+# Boolean mask of the rows matching the cohort filters; filters left empty match
+# every row. `volume` applies to the treated side(s) given by Laterality.
+def cohort_mask(df, laterality=None, volume=None, fractionation=None, min_follow_up=None,
+                radiotherapy_from=None, radiotherapy_to=None, latest_visit_only=False):
+    mask = np.ones(len(df), dtype=bool)
+    if laterality:
+        mask &= df["Laterality"].isin(laterality).to_numpy()
+    if volume:
+        left = df["Laterality"].isin(["Left", "Bilateral"]) & df["Volume - Left Breast"].isin(volume)
+        right = df["Laterality"].isin(["Right", "Bilateral"]) & df["Volume - Right Breast"].isin(volume)
+        mask &= (left | right).to_numpy()
+    if fractionation:
+        mask &= list_contains_any(df["Fractionation"], fractionation)
+    if min_follow_up:
+        mask &= (df["Follow_up_time"] >= min_follow_up).to_numpy()
+    if radiotherapy_from:
+        mask &= (df["Date_of_Last_Radiotherapy"] >= pd.Timestamp(radiotherapy_from)).to_numpy()
+    if radiotherapy_to:
+        mask &= (df["Date_of_Last_Radiotherapy"] <= pd.Timestamp(radiotherapy_to)).to_numpy()
+    if latest_visit_only:
+        order = np.argsort(df["Follow_up_date"].to_numpy(), kind="stable")
+        latest = np.zeros(len(df), dtype=bool)
+        latest[order[~df["MRN"].iloc[order].duplicated(keep="last").to_numpy()]] = True
+        mask &= latest
+    return mask
+
+
+# Lists are written the way the workbook has always shown them: "['IDC', 'ILC']"
+def flatten_lists(chunk):
+    for column in chunk.columns:
+        if chunk[column].dtype == LIST_DTYPE:
+            chunk[column] = [str(list(value)) if value is not None else None for value in chunk[column]]
+    return chunk
+
+
+# Matching rows are copied out of the shared frame `chunksize` at a time and
+# written straight to a temporary file, so an export never holds a second copy
+# of the registry in memory.
+def export_cohort(df, mask, file_format, chunksize=10000):
+    positions = np.flatnonzero(mask)
+    chunks = (df.iloc[positions[start:start + chunksize]] for start in range(0, len(positions), chunksize))
+    out = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+
+    if file_format == "CSV":
+        header = True
+        for chunk in chunks:
+            out.write(flatten_lists(chunk.copy()).to_csv(index=False, header=header).encode("utf-8"))
+            header = False
+        if header:
+            out.write(df.iloc[:0].to_csv(index=False).encode("utf-8"))
+    elif file_format == "Parquet":
+        # Text columns hold strings or nothing; an empty frame cannot tell
+        schema = pa.Schema.from_pandas(df.iloc[:0], preserve_index=False)
+        for i, field in enumerate(schema):
+            if pa.types.is_null(field.type):
+                schema = schema.set(i, field.with_type(pa.string()))
+        # Leave out pandas metadata so any Parquet reader (R arrow, pandas) opens the file
+        schema = schema.remove_metadata()
+        with pq.ParquetWriter(out, schema) as writer:
+            for chunk in chunks:
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    elif file_format == "Excel":
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(list(df.columns))
+        for chunk in chunks:
+            chunk = flatten_lists(chunk.copy()).astype(object)
+            for row in chunk.itertuples(index=False):
+                sheet.append([None if pd.isna(value) else value for value in row])
+        workbook.save(out)
+    else:
+        raise ValueError(f"Unknown export format: {file_format}")
+
+    out.seek(0)
+    return out
+
+
+# Extracts without the app, e.g. from a scheduled task. Only the radiotherapy
+# years asked for are read from the share:
+# python export.py cohort.parquet --format Parquet --radiotherapy-from 2020-01-01 --radiotherapy-to 2021-12-31
+if __name__ == "__main__":
+    import argparse
+    import shutil
+
+    from registry import read_registry
+
+    parser = argparse.ArgumentParser(description="Export part of the breast registry.")
+    parser.add_argument("output")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="CSV")
+    parser.add_argument("--radiotherapy-from", help="first date of last radiotherapy (YYYY-MM-DD)")
+    parser.add_argument("--radiotherapy-to", help="last date of last radiotherapy (YYYY-MM-DD)")
+    parser.add_argument("--mrn", action="append", help="only this MRN; may be repeated")
+    parser.add_argument("--latest-visit-only", action="store_true")
+    parser.add_argument("--as-of", help="only the rows saved up to this local time (YYYY-MM-DD HH:MM), for a data cut")
+    args = parser.parse_args()
+
+    df = read_registry(args.radiotherapy_from, args.radiotherapy_to, args.mrn, args.as_of)
+    mask = cohort_mask(df, latest_visit_only=args.latest_visit_only)
+    with export_cohort(df, mask, args.format) as exported, open(args.output, "wb") as f:
+        shutil.copyfileobj(exported, f)
@@ -0,0 +1,223 @@
+import gc
+import re
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from schema import CHOICE_COLUMNS, COLUMNS, DATE_COLUMNS, GRADES_6, LIST_COLUMNS, LIST_OPTIONS, ORDINAL_COLUMNS, parse_list
+
+# Headers used by older registries for columns that have since been renamed
+ALIASES = {
+    "timesincetreatment": "Follow_up_time",
+    "volumeleft": "Volume - Left Breast",
+    "volumeright": "Volume - Right Breast",
+}
+
+
+# Single-choice columns the form saves as "N/A" when the question does not apply
+NOT_APPLICABLE = ["Cancer Related Death"]
+
+
+# Headers are matched ignoring case, spaces, underscores and punctuation, so
+# "Followup_Date", "follow up date" and "Follow_up_date" all land in the same column
+def column_key(name):
+    return re.sub(r"[^a-z0-9]", "", str(name).lower())
+
+
+def map_columns(headers):
+    known = {column_key(column): column for column in COLUMNS}
+    known.update(ALIASES)
+    mapping, unmapped = {}, []
+    for header in headers:
+        column = known.get(column_key(header))
+        if column and column not in mapping.values():
+            mapping[header] = column
+        else:
+            unmapped.append(header)
+    return mapping, unmapped
+
+
+# Read a CSV or Excel file in chunks of `chunksize` rows, every value as text
+def read_chunks(file, name, chunksize):
+    if name.lower().endswith((".xlsx", ".xlsm")):
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        headers = [str(header) for header in next(rows, [])]
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunksize:
+                yield pd.DataFrame(chunk, columns=headers).astype(object)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=headers).astype(object)
+        workbook.close()
+    else:
+        yield from pd.read_csv(file, dtype=str, chunksize=chunksize, skipinitialspace=True)
+
+
+# Answers are matched to the form's options ignoring case; grades on the
+# roman-numeral scales may also be written as numbers ("2" for "II")
+def option_lookup(options):
+    lookup = {option.lower(): option for option in options}
+    for number, grade in enumerate(GRADES_6):
+        if grade in options:
+            lookup.setdefault(str(number), grade)
+    return lookup
+
+
+# Single-choice answers of a column as the form's options. Returns the answers
+# and, per row, the value that matches no option (or None).
+def import_choices(series, options):
+    lookup = option_lookup(options)
+    # Columns hold a handful of distinct values, so each is matched only once;
+    # empty cells get code -1, which picks the None added at the end
+    codes, values = pd.factorize(series)
+    matches = [lookup.get(str(value).strip().removesuffix(".0").lower()) for value in values]
+    unknown = [None if match else value for value, match in zip(values, matches)]
+    return np.array(matches + [None], dtype=object)[codes], np.array(unknown + [None], dtype=object)[codes]
+
+
+# Note the unmatched values of `column` on rows that have no other problem
+def report_unknown(problems, column, unknown):
+    unknown = pd.Series(unknown, index=problems.index, dtype=object)
+    if unknown.isna().all():
+        return problems
+    return problems.mask(unknown.notna() & (problems == ""), f"Unknown {column}: " + unknown.astype(str))
+
+
+# Multiselect answers of a column as lists of the form's options. Text cells are
+# cleaned, split and matched by Arrow in one pass over the column; answers in
+# other sites' files may also be separated by ";" or "|". Other cells (empty, or
+# numbers read from Excel) go through parse_list. Returns the lists and, per
+# row, the first item that matches no option (or None).
+def import_lists(series, options):
+    lookup = option_lookup(options)
+    is_text = np.array([isinstance(value, str) for value in series], dtype=bool)
+    lists = [[] if text else parse_list(value) for value, text in zip(series, is_text)]
+    unknown = [None] * len(series)
+    for position in np.flatnonzero(~is_text):
+        items = [lookup.get(item.lower()) for item in lists[position]]
+        if None in items:
+            unknown[position] = lists[position][items.index(None)]
+        lists[position] = items
+    if not is_text.any():
+        return lists, unknown
+    strings = pa.array(series[is_text], type=pa.string())
+    # Literal replaces, which Arrow runs much faster than one regular expression
+    cleaned = strings
+    for character, replacement in (("[", ""), ("]", ""), ("'", ""), (";", ","), ("|", ",")):
+        cleaned = pc.replace_substring(cleaned, character, replacement)
+    split = pc.split_pattern(cleaned, ",")
+    items = pc.utf8_trim_whitespace(pc.list_flatten(split))
+    parents = np.asarray(pc.list_parent_indices(split))
+    not_available = np.asarray(pc.equal(pc.utf8_trim_whitespace(strings), "N/A"))
+    keep = np.asarray(pc.not_equal(items, "")) & ~not_available[parents]
+    items, parents = items.filter(pa.array(keep)), parents[keep]
+    matches = pc.index_in(pc.utf8_lower(items), value_set=pa.array(list(lookup), type=pa.string()))
+    # The first unmatched item of each row, found from the last one backwards
+    unmatched = np.flatnonzero(np.asarray(pc.is_null(matches)))[::-1]
+    rows = np.flatnonzero(is_text)
+    for position, item in zip(rows[parents[unmatched]].tolist(), pc.take(items, pa.array(unmatched, type=pa.int64())).to_pylist()):
+        unknown[position] = item
+    items = pc.take(pa.array(list(lookup.values()), type=pa.string()), matches).to_pylist()
+    ends = np.cumsum(np.bincount(parents, minlength=len(strings)))
+    starts = np.concatenate([[0], ends[:-1]])
+    for position, start, end in zip(rows, starts.tolist(), ends.tolist()):
+        lists[position] = items[start:end]
+    return lists, unknown
+
+
+# Map a chunk onto the registry columns and normalize it the way the form saves
+# data. Returns the clean rows and a list of (row number, MRN, error) tuples.
+# `dayfirst` reads dates such as 05/03/2021 as 5 March rather than 3 May.
+def prepare_chunk(chunk, mapping, first_row, dayfirst=False):
+    chunk = chunk.rename(columns=mapping)[list(mapping.values())]
+    chunk.index = range(first_row, first_row + len(chunk))
+    chunk = chunk.where(chunk.notna(), None)
+
+    mrn = chunk["MRN"].astype(str).str.strip().str.removesuffix(".0") if "MRN" in chunk else pd.Series(None, index=chunk.index)
+    problems = pd.Series("", index=chunk.index)
+    problems = problems.mask(mrn.isin(["", "None", "nan"]) | mrn.isna(), "Missing MRN")
+    chunk["MRN"] = mrn
+
+    for column in DATE_COLUMNS:
+        if column not in chunk:
+            continue
+        dates = pd.to_datetime(chunk[column], errors="coerce", format="mixed", dayfirst=dayfirst)
+        unreadable = chunk[column].notna() & dates.isna()
+        problems = problems.mask(unreadable & (problems == ""), f"Unreadable {column}")
+        chunk[column] = dates.dt.strftime("%Y-%m-%d").where(dates.notna(), None)
+    if "Follow_up_date" not in chunk:
+        chunk["Follow_up_date"] = None
+    problems = problems.mask(chunk["Follow_up_date"].isna() & (problems == ""), "Missing Follow_up_date")
+
+    for column, options in {**ORDINAL_COLUMNS, **CHOICE_COLUMNS}.items():
+        if column in chunk:
+            chunk[column], unknown = import_choices(chunk[column], options + (["N/A"] if column in NOT_APPLICABLE else []))
+            problems = report_unknown(problems, column, unknown)
+
+    for column in LIST_COLUMNS:
+        if column in chunk:
+            chunk[column], unknown = import_lists(chunk[column], LIST_OPTIONS[column])
+            problems = report_unknown(problems, column, unknown)
+
+    failed = problems != ""
+    errors = list(zip(problems.index[failed], mrn[failed], problems[failed]))
+    return chunk[~failed], errors
+
+
+# Stream a historical registry into `registry` in batches of `chunksize` rows.
+# Rows already in the registry, or repeated in the file, with the same MRN and
+# follow-up date are skipped. `progress` is called with the rows read so far.
+def import_registry(file, name, registry, chunksize=5000, progress=None, dayfirst=False):
+    # An import creates millions of small lists and dicts while the registry it
+    # adds them to grows, and the garbage collector's full passes over that heap
+    # took about 40% of the time. Nothing here creates reference cycles, so
+    # collection is paused until the import ends.
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        return import_batches(file, name, registry, chunksize, progress, dayfirst)
+    finally:
+        if collecting:
+            gc.enable()
+
+
+def import_batches(file, name, registry, chunksize, progress, dayfirst):
+    seen = registry.visit_keys()
+    report = {"Rows read": 0, "Imported": 0, "Duplicates": 0, "Errors": 0}
+    errors = []
+    mapping = unmapped = None
+    for chunk in read_chunks(file, name, chunksize):
+        if mapping is None:
+            mapping, unmapped = map_columns(chunk.columns)
+        # Row numbers as shown in a spreadsheet, below the header row
+        rows, chunk_errors = prepare_chunk(chunk, mapping, report["Rows read"] + 2, dayfirst)
+        report["Rows read"] += len(chunk)
+
+        new = []
+        for key in zip(rows["MRN"], rows["Follow_up_date"]):
+            new.append(key not in seen)
+            seen.add(key)
+        duplicates = len(new) - sum(new)
+        if len(rows):
+            rows = rows[new]
+
+        if len(rows):
+            # Built from the columns: to_dict("records") converts every cell on its own
+            columns = list(rows.columns)
+            registry.append_many([dict(zip(columns, values))
+                                  for values in zip(*(rows[column].tolist() for column in columns))])
+        report["Imported"] += len(rows)
+        report["Duplicates"] += duplicates
+        report["Errors"] += len(chunk_errors)
+        errors.extend(chunk_errors)
+        if progress:
+            progress(report["Rows read"])
+
+    report["Unmapped columns"] = ", ".join(unmapped or [])
+    return report, pd.DataFrame(errors, columns=["Row", "MRN", "Error"])
@@ -0,0 +1,227 @@
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from functools import wraps
+
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# Set to False to turn every timer into a single flag check
+enabled = True
+# Prometheus text file for node_exporter's textfile collector (or anything that
+# scrapes files), rewritten every `export_every` seconds; None to not write it.
+# Defaults to state/ next to the app, which docker-compose.yml mounts from the
+# host; BREAST_CLINIC_METRICS_FILE moves it elsewhere, or turns it off when empty.
+metrics_file = os.environ.get("BREAST_CLINIC_METRICS_FILE", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "state", "breast_clinic.prom")) or None
+export_every = 15
+# The performance page is only shown to whoever knows this password
+admin_password = os.environ.get("BREAST_CLINIC_ADMIN_PASSWORD")
+# The in-app panel reports the last hour, in one-minute slots
+window = 3600
+slot_seconds = 60
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = tuple(1024 * 4 ** power for power in range(11))
+
+METRICS = {
+    "load_data_seconds": ("Time to return the registry frame", SECONDS_BUCKETS),
+    "get_patient_data_seconds": ("Time to look up the latest visit of an MRN", SECONDS_BUCKETS),
+    "search_patients_seconds": ("Time to find patients by partial MRN or dates", SECONDS_BUCKETS),
+    "audit_seconds": ("Time to audit the registry for data-quality issues", SECONDS_BUCKETS),
+    "save_data_seconds": ("Time for a save to return to the clinician", SECONDS_BUCKETS),
+    "script_rerun_seconds": ("Time of a full rerun of the form page", SECONDS_BUCKETS),
+    "patient_panel_seconds": ("Time of a rerun of the MRN lookup and form", SECONDS_BUCKETS),
+    "log_read_seconds": ("Time to read new lines of the registry log on the share", SECONDS_BUCKETS),
+    "log_read_bytes": ("Bytes read from the registry log on the share", BYTES_BUCKETS),
+    "log_append_seconds": ("Time to append and fsync rows to the registry log on the share", SECONDS_BUCKETS),
+    "log_append_bytes": ("Bytes appended to the registry log on the share", BYTES_BUCKETS),
+    "journal_read_seconds": ("Time to read the local journal when the server starts", SECONDS_BUCKETS),
+    "journal_read_bytes": ("Bytes read from the local journal when the server starts", BYTES_BUCKETS),
+    "journal_append_seconds": ("Time to append and fsync saves to the local journal", SECONDS_BUCKETS),
+    "journal_append_bytes": ("Bytes appended to the local journal", BYTES_BUCKETS),
+    "workbook_read_seconds": ("Time to read Breast_clinic.xlsx", SECONDS_BUCKETS),
+    "workbook_read_bytes": ("Size of Breast_clinic.xlsx when read", BYTES_BUCKETS),
+    "workbook_write_seconds": ("Time to export Breast_clinic.xlsx", SECONDS_BUCKETS),
+    "workbook_write_bytes": ("Size of Breast_clinic.xlsx when exported", BYTES_BUCKETS),
+}
+
+
+# Fixed-bucket histogram. Totals since the server started are kept for
+# Prometheus, and per-minute slots for the rolling window shown in the app.
+class Histogram:
+    def __init__(self, description, buckets):
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        # [slot number, bucket counts, sum, max], newest last
+        self.slots = deque(maxlen=window // slot_seconds)
+
+    def observe(self, value):
+        bucket = bisect_left(self.buckets, value)
+        slot_number = int(time.time() // slot_seconds)
+        self.counts[bucket] += 1
+        self.sum += value
+        if not self.slots or self.slots[-1][0] != slot_number:
+            self.slots.append([slot_number, [0] * len(self.counts), 0.0, 0.0])
+        slot = self.slots[-1]
+        slot[1][bucket] += 1
+        slot[2] += value
+        slot[3] = max(slot[3], value)
+
+    # Bucket counts, sum and max over the slots still inside the window
+    def recent(self):
+        first = int(time.time() // slot_seconds) - window // slot_seconds + 1
+        counts, total, largest = [0] * len(self.counts), 0.0, 0.0
+        for slot_number, slot_counts, slot_sum, slot_max in self.slots:
+            if slot_number >= first:
+                counts = [a + b for a, b in zip(counts, slot_counts)]
+                total += slot_sum
+                largest = max(largest, slot_max)
+        return counts, total, largest
+
+    # Interpolated within the bucket holding the quantile, like Prometheus'
+    # histogram_quantile; values past the last bucket report its bound
+    def quantile(self, q, counts):
+        observed = sum(counts)
+        if not observed:
+            return math.nan
+        rank = q * observed
+        cumulative = 0
+        for bucket, count in enumerate(counts):
+            if cumulative + count >= rank:
+                if bucket == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[bucket - 1] if bucket else 0
+                return lower + (self.buckets[bucket] - lower) * (rank - cumulative) / count
+            cumulative += count
+
+
+lock = threading.Lock()
+histograms = {name: Histogram(description, buckets) for name, (description, buckets) in METRICS.items()}
+# Session id -> [full reruns, total rerun seconds, time of the last rerun]
+sessions = {}
+exporter = None
+
+
+def observe(name, value):
+    if not enabled:
+        return
+    with lock:
+        histograms[name].observe(value)
+
+
+# Record the duration of every call of the decorated function
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+# Record a full rerun of the form page, for the server and for the session
+def observe_rerun(seconds):
+    if not enabled:
+        return
+    observe("script_rerun_seconds", seconds)
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return
+    now = time.time()
+    with lock:
+        session = sessions.setdefault(ctx.session_id, [0, 0.0, now])
+        session[0] += 1
+        session[1] += seconds
+        session[2] = now
+        # Forget sessions idle for longer than the window
+        for session_id in [key for key, value in sessions.items() if value[2] < now - window]:
+            del sessions[session_id]
+
+
+# Count, percentiles and totals of every metric over the rolling window
+def summary():
+    rows = []
+    with lock:
+        for name, histogram in histograms.items():
+            counts, total, largest = histogram.recent()
+            observed = sum(counts)
+            # Bucket interpolation can overshoot the largest value actually seen
+            rows.append({
+                "Metric": name,
+                "Count": observed,
+                "p50": min(histogram.quantile(0.5, counts), largest),
+                "p95": min(histogram.quantile(0.95, counts), largest),
+                "p99": min(histogram.quantile(0.99, counts), largest),
+                "Max": largest if observed else math.nan,
+                "Total": total,
+            })
+    return rows
+
+
+def session_summary():
+    with lock:
+        return [{
+            "Session": session_id[:8],
+            "Reruns": reruns,
+            "Total seconds": total,
+            "Mean seconds": total / reruns,
+            "Last rerun": time.strftime("%H:%M:%S", time.localtime(last)),
+        } for session_id, (reruns, total, last) in sessions.items()]
+
+
+# Every histogram since the server started, in the Prometheus text format
+def prometheus_text():
+    lines = []
+    with lock:
+        for name, histogram in histograms.items():
+            metric = "breast_clinic_" + name
+            lines.append(f"# HELP {metric} {histogram.description}")
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum {histogram.sum}")
+            lines.append(f"{metric}_count {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics_file(path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
+
+
+def run_exporter(path):
+    while True:
+        time.sleep(export_every)
+        try:
+            write_metrics_file(path)
+        except OSError:
+            # Metrics must never get in the way of the clinic; try again next time
+            continue
+
+
+# Start writing the metrics file in the background, once per server process
+def start_exporter():
+    global exporter
+    if not enabled or not metrics_file:
+        return
+    with lock:
+        if exporter is not None:
+            return
+        os.makedirs(os.path.dirname(metrics_file), exist_ok=True)
+        exporter = threading.Thread(target=run_exporter, args=(metrics_file,), name="metrics-exporter", daemon=True)
+        exporter.start()
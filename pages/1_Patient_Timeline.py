@@ -0,0 +1,40 @@
+from datetime import datetime, time
+
+import streamlit as st
+
+from analytics import TOXICITY_COLUMNS, patient_timeline, recurrence_events
+from registry import get_patient_history, get_patient_visits
+
+st.title("Patient Timeline")
+st.write("Enter the MRN of a patient to see every follow-up visit, the side effect grades over time and any recurrence events.")
+
+mrn = st.text_input("Enter MRN (Medical Record Number) and press Enter", key="timeline_mrn")
+as_of = st.date_input("As recorded on (leave empty for today)", value=None, key="timeline_as_of")
+
+if mrn:
+    visits = get_patient_visits(mrn, datetime.combine(as_of, time.max) if as_of else None)
+    if not len(visits):
+        st.warning("No follow-up visits were found for this MRN.")
+    else:
+        timeline = patient_timeline(visits)
+        st.write(f"**Visits**: {len(visits)}")
+
+        st.subheader("Side Effects over Time")
+        st.write("Grades are plotted as numbers: 0 is no change, 1 is grade I and so on. Cosmetic outcome goes from 0 (Excellent) to 3 (Poor).")
+        selected = st.multiselect("Side effects", TOXICITY_COLUMNS, default=["Radiodermatitis", "Breast_fibrosis", "Cosmetic_outcome"])
+        if selected:
+            st.line_chart(timeline, x="Months since radiotherapy", y=selected)
+
+        st.subheader("Recurrence Events")
+        events = recurrence_events(visits)
+        if len(events):
+            st.dataframe(events, hide_index=True)
+        else:
+            st.write("No recurrence or death has been recorded.")
+
+        st.subheader("Visits")
+        st.dataframe(visits, hide_index=True)
+
+        st.subheader("Change History")
+        st.write("Every save of this patient, with who entered it and the values that differ from the save before.")
+        st.dataframe(get_patient_history(mrn), hide_index=True)
@@ -0,0 +1,43 @@
+import streamlit as st
+
+from analytics import EVENT_COLUMNS, TOXICITY_COLUMNS, grade_distribution, patient_outcomes, survival_curve, survival_summary
+from registry import get_data_version, load_data
+
+# Results are cached per registry version, so the page opens instantly until a
+# follow-up is saved
+
+# One row per patient, shared by every analysis of the same registry version
+@st.cache_resource(max_entries=1)
+def get_outcomes(version):
+    return patient_outcomes(load_data())
+
+@st.cache_data(max_entries=50)
+def get_grade_distribution(version, column):
+    return grade_distribution(get_outcomes(version), column)
+
+@st.cache_data(max_entries=20)
+def get_survival(version, event, replicates):
+    outcomes = get_outcomes(version)
+    curve = survival_curve(outcomes[event + "_months"], outcomes[event], replicates=replicates)
+    return curve, survival_summary(curve, outcomes, event)
+
+
+st.title("Cohort Analytics")
+st.write("Crude toxicity rates and time-to-event curves over the whole registry. Each patient counts once: with the worst grade recorded at any follow-up and the fractionation of the latest visit.")
+
+version = get_data_version()
+outcomes = get_outcomes(version)
+st.write(f"**Patients**: {len(outcomes)}")
+
+st.subheader("Side Effects by Fractionation")
+toxicity = st.selectbox("Side effect", TOXICITY_COLUMNS)
+st.write("Percentage of patients by worst grade for each fractionation schedule.")
+distribution = get_grade_distribution(version, toxicity)
+st.dataframe(distribution.style.format("{:.1f}", subset=list(distribution.columns[1:])))
+
+st.subheader("Time to Event")
+event = st.selectbox("Event", list(EVENT_COLUMNS), format_func=lambda column: column.replace("_", " ").capitalize())
+replicates = st.select_slider("Bootstrap resamples for the 95% confidence interval", [0, 100, 200, 500, 1000], value=200)
+curve, summary = get_survival(version, event, replicates)
+st.line_chart(curve, x="Months", y=["Survival", "Lower", "Upper"])
+st.dataframe([summary], hide_index=True)
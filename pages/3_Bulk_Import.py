@@ -0,0 +1,24 @@
+import streamlit as st
+
+from importer import import_registry
+from registry import get_registry
+
+st.title("Bulk Import")
+st.write("Import historical registries from CSV or Excel files. Columns are matched to the registry by name, MRNs and multiselect fields are normalized, answers are matched to the form's options ignoring case, and rows whose MRN and follow-up date are already in the registry are skipped.")
+
+uploaded = st.file_uploader("Registry file", type=["csv", "xlsx"])
+chunksize = st.number_input("Rows per batch", min_value=100, max_value=100000, value=5000, step=100)
+dayfirst = st.checkbox("Dates are written day first (05/03/2021 is 5 March)")
+
+if uploaded and st.button("Import"):
+    progress = st.empty()
+    report, errors = import_registry(uploaded, uploaded.name, get_registry(), chunksize=int(chunksize),
+                                     progress=lambda rows: progress.write(f"{rows} rows read..."), dayfirst=dayfirst)
+    progress.empty()
+    st.success(f"Imported {report['Imported']} of {report['Rows read']} rows.")
+    st.dataframe([report], hide_index=True)
+
+    if len(errors):
+        st.subheader("Rows not imported")
+        st.dataframe(errors, hide_index=True)
+        st.download_button("Download error report", errors.to_csv(index=False), file_name="import_errors.csv", mime="text/csv")
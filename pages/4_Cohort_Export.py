@@ -0,0 +1,47 @@
+from datetime import datetime, time
+
+import numpy as np
+import streamlit as st
+
+from export import EXPORT_FORMATS, cohort_mask, export_cohort
+from registry import audit_data, load_data, load_data_as_of
+from schema import CHOICE_COLUMNS, LIST_OPTIONS
+
+st.title("Cohort Export")
+st.write("Select the patients to extract. Filters left empty include every patient.")
+
+# A data cut: the registry as it was at the end of a past day. Rows are only ever
+# appended, so the same cut can be exported again later with the same rows.
+as_of = st.date_input("Registry as of (leave empty for the current registry)", value=None)
+df = load_data_as_of(datetime.combine(as_of, time.max)) if as_of else load_data()
+
+laterality = st.multiselect("Laterality", CHOICE_COLUMNS["Laterality"])
+volume = st.multiselect("Volume of the treated breast", CHOICE_COLUMNS["Volume - Left Breast"])
+fractionation = st.multiselect("Fractionation", LIST_OPTIONS["Fractionation"])
+min_follow_up = st.number_input("Minimum follow-up time (months)", min_value=0, value=0)
+radiotherapy_dates = st.date_input("Date of last radiotherapy between", value=[])
+latest_visit_only = st.checkbox("Only the latest visit of each patient")
+
+mask = cohort_mask(
+    df, laterality=laterality, volume=volume, fractionation=fractionation, min_follow_up=min_follow_up,
+    radiotherapy_from=radiotherapy_dates[0] if len(radiotherapy_dates) > 0 else None,
+    radiotherapy_to=radiotherapy_dates[1] if len(radiotherapy_dates) > 1 else None,
+    latest_visit_only=latest_visit_only,
+)
+st.write(f"**Matching rows**: {mask.sum()} of {len(df)} (**patients**: {df['MRN'][mask].nunique()})")
+
+# Audited before every export; issues are matched to the rows by their position
+# in the registry, which is the index of `df`
+rows = audit_data()["Row"].to_numpy()
+flagged = np.isin(df.index.to_numpy()[mask], rows).sum()
+if flagged:
+    st.warning(f"{flagged} of the matching rows have data-quality issues. See the Data Quality page before using this export.")
+
+file_format = st.radio("Format", list(EXPORT_FORMATS), horizontal=True)
+if st.button("Prepare export"):
+    extension, mime = EXPORT_FORMATS[file_format]
+    # Streamlit serves downloads from memory, so only the finished file is read in
+    with export_cohort(df, mask, file_format) as exported:
+        data = exported.read()
+    st.download_button(f"Download {file_format}", data,
+                       file_name=f"breast_cohort.{extension}", mime=mime)
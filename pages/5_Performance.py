@@ -0,0 +1,52 @@
+import hmac
+
+import pandas as pd
+import streamlit as st
+
+import metrics
+
+st.title("Performance")
+
+if not metrics.admin_password:
+    st.info("Set BREAST_CLINIC_ADMIN_PASSWORD on the server to open this page.")
+    st.stop()
+if not st.session_state.get("performance_admin"):
+    password = st.text_input("Admin password", type="password")
+    if not hmac.compare_digest(password.encode(), metrics.admin_password.encode()):
+        if password:
+            st.error("Wrong password.")
+        st.stop()
+    st.session_state.performance_admin = True
+
+if not metrics.enabled:
+    st.warning("Instrumentation is turned off (`enabled = False` in metrics.py).")
+
+st.write(f"Timings and transfer sizes over the last {metrics.window // 60} minutes, from every session of this server. Percentiles are estimated from histogram buckets.")
+
+# Refreshed in place while the page is open
+@st.fragment(run_every="10s")
+def performance_panel():
+    summary = pd.DataFrame(metrics.summary())
+    timings = summary[summary["Metric"].str.endswith("_seconds")].copy()
+    timings[["p50", "p95", "p99", "Max"]] *= 1000
+    st.subheader("Timings (ms)")
+    st.dataframe(timings.rename(columns={"Total": "Total seconds"}).style.format(precision=1), hide_index=True)
+
+    sizes = summary[summary["Metric"].str.endswith("_bytes")].copy()
+    sizes[["p50", "p95", "p99", "Max", "Total"]] /= 2 ** 20
+    st.subheader("Transfers (MB)")
+    st.dataframe(sizes.style.format(precision=2), hide_index=True)
+
+    st.subheader("Form Page Reruns by Session")
+    sessions = metrics.session_summary()
+    if sessions:
+        st.dataframe(pd.DataFrame(sessions).style.format(precision=3), hide_index=True)
+    else:
+        st.write("No reruns recorded yet.")
+
+performance_panel()
+
+st.subheader("Prometheus")
+if metrics.metrics_file:
+    st.write(f"Totals since the server started are written every {metrics.export_every} seconds to `{metrics.metrics_file}` for a textfile collector.")
+st.download_button("Download metrics", metrics.prometheus_text(), file_name="breast_clinic.prom", mime="text/plain")
@@ -0,0 +1,24 @@
+import streamlit as st
+
+from audit import issues_by_patient
+from registry import audit_data
+
+st.title("Data Quality")
+st.write("Every visit in the registry is checked for known data-entry problems: follow-ups dated before the radiotherapy, dates left at the 1900-01-01 default, LVI copied from the PR result, breast volumes reset to 'Whole Breast' and values saved under the wrong column name.")
+
+issues = audit_data()
+if not len(issues):
+    st.success("No issues found.")
+    st.stop()
+
+st.write(f"**Issues**: {len(issues)} on {issues['Row'].nunique()} visits of {issues['MRN'].nunique()} patients")
+st.dataframe(issues.groupby(["Rule", "Issue"]).size().rename("Visits").reset_index(), hide_index=True)
+
+st.subheader("By Patient")
+patients = issues_by_patient(issues)
+st.dataframe(patients, hide_index=True)
+mrn = st.selectbox("Show the issues of", patients["MRN"], index=None)
+if mrn:
+    st.dataframe(issues[issues["MRN"] == mrn].drop(columns="Row"), hide_index=True)
+
+st.download_button("Download issue report", issues.to_csv(index=False), file_name="registry_issues.csv", mime="text/csv")
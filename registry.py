@@ -0,0 +1,588 @@
+import os
+import threading
+import time
+import uuid
+from bisect import insort
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+import metrics
+from audit import Audit
+from schema import COLUMNS, apply_schema, parse_list
+from search import PatientSearch
+from storage import (ROW_METADATA, FileLock, RowLog, WriteBehind, export_workbook, new_entry, partition_names,
+                     read_snapshot, saved_at_key, write_snapshot)
+
+# File path for local storage
+excel_file = "I:\Radiation Oncology Clinical Trials - 1\BREAST\Breast Registry\Breast_clinic.xlsx"
+# Append-only log holding the registry rows; the workbook above is exported from it
+registry_log = os.path.splitext(excel_file)[0] + ".jsonl"
+# Typed Parquet snapshot of the log, one partition per year of last radiotherapy;
+# after every `compact_every` new rows the partitions that gained rows are rewritten
+registry_snapshot = os.path.splitext(excel_file)[0] + "_parquet"
+compact_every = 500
+# Save through a journal on the local disk and a background writer instead of
+# making the clinician wait for the network share. The journal must outlive the
+# server, so it defaults to state/ next to the app, which docker-compose.yml
+# mounts from the host; BREAST_CLINIC_JOURNAL moves it elsewhere.
+write_behind = True
+journal_file = os.environ.get("BREAST_CLINIC_JOURNAL") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "state", "journal.jsonl")
+
+# Helper function to calculate time in months
+def calculate_months(start_date, end_date):
+    return (end_date.year - start_date.year) * 12 + (end_date.month - start_date.month)
+
+# Function to safely retrieve data, handling NaN values
+def safe_get(data, key, default=""):
+    value = data.get(key, default)
+    return value if pd.notna(value) else default
+
+# Function to safely retrieve a list from stored list or string values
+def safe_get_list(data, key):
+    return parse_list(data.get(key, ""))
+
+# Function to safely retrieve a date from stored datetime or string values
+def safe_get_date(data, key, default="1900-01-01"):
+    value = pd.to_datetime(safe_get(data, key, default), errors="coerce")
+    return value.date() if pd.notna(value) else pd.Timestamp(default).date()
+
+
+# Sort key for a follow-up date; ISO strings order chronologically and
+# missing dates sort before every real visit
+def visit_sort_key(value):
+    # Dates saved by the form and the importer are already ISO strings
+    if isinstance(value, str) and len(value) >= 10 and value[4] == "-" and value[7] == "-":
+        return value[:10]
+    if value is None or value is pd.NaT:
+        return ""
+    # Dates picked in the app, including datetimes and Timestamps
+    if isinstance(value, date):
+        return value.isoformat()[:10]
+    value = pd.to_datetime(value, errors="coerce")
+    return value.strftime("%Y-%m-%d") if pd.notna(value) else ""
+
+
+# A registry row the way the log stores it: ISO dates, plain lists and None for
+# missing values
+def log_values(data):
+    values = {}
+    for key, value in data.items():
+        if isinstance(value, (list, tuple, np.ndarray)):
+            value = [str(item) for item in value]
+        elif isinstance(value, date) and value is not pd.NaT:
+            value = value.isoformat()[:10]
+        elif pd.isna(value):
+            value = None
+        values[key] = value
+    return values
+
+
+# A row saved as changes (see Registry.delta) completed from the row it was saved
+# against; left as it is if that row cannot be found
+def complete_row(row, base):
+    row = dict(row)
+    row.pop("_base", None)
+    if base is None:
+        return row
+    values = {key: value for key, value in log_values(base).items() if not key.startswith("_")}
+    values.update(row)
+    return values
+
+
+# In-memory copy of the registry, shared by every session of the server process.
+# Rows live in an append-only log; the typed snapshot and the log lines after it
+# are read once, and afterwards only the lines appended since the last read (by
+# this or another server) are added.
+class Registry:
+    def __init__(self, log_path, workbook_path, journal_path=None, snapshot_path=None):
+        self.log = RowLog(log_path, "log")
+        self.snapshot_path = snapshot_path
+        self.snapshot_rows = 0
+        self.compacting = False
+        self.file_lock = FileLock(log_path + ".lock")
+        self.workbook_path = workbook_path
+        self.lock = threading.RLock()
+        self.df = None
+        # Rows read or saved since the frame was last materialized
+        self.pending = []
+        self.row_count = 0
+        self.offset = 0
+        self.signature = None
+        # Bumped every time the registry is loaded from scratch
+        self.generation = 0
+        # Normalized MRN -> [(follow-up sort key, row position), ...] oldest visit first
+        self.mrn_index = {}
+        # MRN prefix and date of birth / radiotherapy indexes for finding patients
+        self.patient_search = PatientSearch()
+        # Data-quality issues found by the last audit
+        self.audit = Audit()
+        # Entry id -> row position of the rows read so far, used to drop rows
+        # written twice by a retry and to find the row a save was made against
+        self.entries = {}
+        # Entry id, save time and who saved it of each row by position
+        self.row_entries = []
+        self.row_saved_at = []
+        self.row_saved_by = []
+        # Full rows of this server's saves until they are read back from the log,
+        # so they need not be completed again
+        self.saved = {}
+        self.writer = None
+        if journal_path:
+            os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+            self.writer = WriteBehind(self.log, self.file_lock, journal_path, self.refresh)
+            self.refresh()
+            self.writer.recover(self.entries)
+            self.writer.start()
+
+    # Seed the log from the existing workbook the first time the log is used. The
+    # seed is written to a file of its own and renamed into place, so the log never
+    # exists holding only part of the workbook. The workbook is read without the
+    # lock, which other servers break as stale after a minute.
+    def migrate_workbook(self):
+        if self.log.exists() or not os.path.exists(self.workbook_path):
+            return
+        start = time.perf_counter()
+        df = pd.read_excel(self.workbook_path, dtype={"MRN": str})
+        metrics.observe("workbook_read_seconds", time.perf_counter() - start)
+        metrics.observe("workbook_read_bytes", os.path.getsize(self.workbook_path))
+        seed = RowLog(f"{self.log.path}.{uuid.uuid4().hex}.seed")
+        try:
+            seed.append([new_entry(row) for row in df.to_dict("records")])
+            with self.file_lock:
+                # Another server seeded the log while the workbook was read
+                if not self.log.exists():
+                    os.replace(seed.path, self.log.path)
+        finally:
+            if seed.exists():
+                os.remove(seed.path)
+
+    @staticmethod
+    def build_frame(rows):
+        df = pd.DataFrame(rows)
+        extra = [column for column in df.columns if column not in COLUMNS and not column.startswith("_")]
+        return apply_schema(df.reindex(columns=COLUMNS + extra))
+
+    @staticmethod
+    def concat(df, new):
+        if not len(new):
+            return df
+        if not len(df):
+            return new
+        # Categoricals that gained new values come back as object columns
+        return apply_schema(pd.concat([df, new], ignore_index=True))
+
+    def build_index(self, df):
+        dates = pd.to_datetime(df["Follow_up_date"], errors="coerce").dt.strftime("%Y-%m-%d").fillna("")
+        keys = pd.DataFrame({"MRN": df["MRN"].to_numpy(), "date": dates.to_numpy()}, index=range(len(df)))
+        keys = keys.sort_values(["MRN", "date"], kind="stable")
+        index = {}
+        for mrn, follow_up, position in zip(keys["MRN"], keys["date"], keys.index):
+            index.setdefault(mrn, []).append((follow_up, position))
+        return index
+
+    def load(self):
+        self.migrate_workbook()
+        # Take the signature before reading so a write racing with the read is
+        # picked up by the next refresh instead of being masked
+        signature = self.log.signature()
+        snapshot, meta, offset = None, {column: [] for column in ROW_METADATA}, 0
+        if self.snapshot_path and signature is not None:
+            snapshot, meta, offset = read_snapshot(self.snapshot_path)
+            # The log was replaced since the snapshot was taken
+            if offset > signature[1]:
+                snapshot, meta, offset = None, {column: [] for column in ROW_METADATA}, 0
+        rows, offset = self.log.read(offset)
+        self.entries = {entry: position for position, entry in enumerate(meta["_entry"]) if entry is not None}
+        self.row_entries = list(meta["_entry"])
+        self.row_saved_at = list(meta["_saved_at"])
+        self.row_saved_by = list(meta["_saved_by"])
+        snapshot = apply_schema(snapshot) if snapshot is not None else None
+        new = []
+        for row in rows:
+            if self.is_new(row):
+                new.append(self.resolve(row, snapshot, new))
+        df = self.build_frame(new)
+        df["MRN"] = df["MRN"].astype(str).str.strip()
+        self.snapshot_rows = len(snapshot) if snapshot is not None else 0
+        if snapshot is not None:
+            df = self.concat(snapshot, df)
+        self.df = df
+        self.pending = []
+        self.row_count = len(df)
+        self.generation += 1
+        self.offset = offset
+        self.signature = signature
+        self.mrn_index = self.build_index(df)
+        self.patient_search = PatientSearch.build(df)
+
+    def is_new(self, row):
+        entry = row.get("_entry")
+        if entry is not None:
+            if entry in self.entries:
+                return False
+            self.entries[entry] = len(self.row_entries)
+        self.row_entries.append(entry)
+        self.row_saved_at.append(row.get("_saved_at"))
+        self.row_saved_by.append(row.get("_saved_by"))
+        return True
+
+    # Complete a row saved as changes from the row it was saved against, which is
+    # either in `frame` or among the `rows` read after it
+    def resolve(self, row, frame, rows):
+        if "_base" not in row:
+            return row
+        if row.get("_entry") in self.saved:
+            return self.saved.pop(row["_entry"])
+        position = self.entries.get(row["_base"])
+        frame_rows = len(frame) if frame is not None else 0
+        if position is None:
+            base = None
+        elif position < frame_rows:
+            base = frame.iloc[position].to_dict()
+        else:
+            base = rows[position - frame_rows]
+        return complete_row(row, base)
+
+    def add_rows(self, rows):
+        for row in rows:
+            if not self.is_new(row):
+                continue
+            row = self.resolve(row, self.df, self.pending)
+            row["MRN"] = str(row.get("MRN")).strip()
+            self.pending.append(row)
+            insort(self.mrn_index.setdefault(row["MRN"], []),
+                   (visit_sort_key(row.get("Follow_up_date")), self.row_count))
+            self.patient_search.add(row["MRN"], visit_sort_key(row.get("Date_of_Birth")),
+                                    visit_sort_key(row.get("Date_of_Last_Radiotherapy")))
+            self.row_count += 1
+
+    # Pick up rows appended to the log since the last read
+    def refresh(self):
+        signature = self.log.signature()
+        with self.lock:
+            if self.df is None or signature is None or signature[1] < self.offset:
+                self.load()
+            elif signature != self.signature:
+                rows, self.offset = self.log.read(self.offset)
+                self.signature = signature
+                self.add_rows(rows)
+            if self.snapshot_path and not self.compacting and self.row_count - self.snapshot_rows >= compact_every:
+                self.compacting = True
+                threading.Thread(target=self.compact, name="registry-compact", daemon=True).start()
+
+    # Bring the typed snapshot up to everything read from the log so far. Rows
+    # before `snapshot_rows` are already in it, so only the partitions of the
+    # rows after them are rewritten.
+    def compact(self):
+        try:
+            with self.lock:
+                df = self.frame()
+                meta = {"_entry": list(self.row_entries), "_saved_at": list(self.row_saved_at),
+                        "_saved_by": list(self.row_saved_by)}
+                offset = self.offset
+            partitions = partition_names(df["Date_of_Last_Radiotherapy"]).to_numpy()
+            changed = set(partitions[self.snapshot_rows:])
+            with self.file_lock:
+                write_snapshot(df, meta, offset, self.snapshot_path, partitions, changed)
+            self.snapshot_rows = len(df)
+        finally:
+            self.compacting = False
+
+    # Current registry contents; the frame is shared and must not be modified
+    def frame(self):
+        with self.lock:
+            self.refresh()
+            if self.pending:
+                self.df = self.concat(self.df, self.build_frame(self.pending))
+                self.pending = []
+            return self.df
+
+    # Row positions saved up to `timestamp`; rows saved before save times were
+    # recorded belong to every cut
+    def saved_by_then(self, positions, timestamp):
+        key = saved_at_key(timestamp)
+        return [position for position in positions if (self.row_saved_at[position] or "") <= key]
+
+    # The registry as it was at `timestamp`: every row saved up to then. Rows are
+    # only ever appended, so a cut taken for a past time never changes.
+    def as_of(self, timestamp):
+        with self.lock:
+            df = self.frame()
+            saved_at = np.array([value or "" for value in self.row_saved_at], dtype=object)
+        return df.iloc[np.flatnonzero(saved_at <= saved_at_key(timestamp))]
+
+    def row(self, position):
+        if position < len(self.df):
+            # Column by column: taking a row of the mixed-type frame at once is slower
+            return {column: self.df[column].array[position] for column in self.df.columns}
+        return dict(self.pending[position - len(self.df)])
+
+    # Changes whenever rows are added or the registry is reloaded, for keying
+    # results computed from the whole registry
+    def version(self):
+        with self.lock:
+            self.refresh()
+            return (self.generation, self.row_count)
+
+    # Most recent visit of a patient as a dict, None if the MRN is unknown
+    def latest_visit(self, mrn):
+        with self.lock:
+            self.refresh()
+            entries = self.mrn_index.get(mrn)
+            if not entries:
+                return None
+            return self.row(entries[-1][1])
+
+    # All visits of a patient ordered by follow-up date, indexed by row position,
+    # as saved up to `as_of` if given. Read straight from the visit index, so rows
+    # saved since the frame was last materialized do not force the whole registry
+    # to be rebuilt.
+    def visits(self, mrn, as_of=None):
+        with self.lock:
+            self.refresh()
+            positions = [position for _, position in self.mrn_index.get(mrn, [])]
+            if as_of is not None:
+                positions = self.saved_by_then(positions, as_of)
+            stored = [position for position in positions if position < len(self.df)]
+            recent = [position for position in positions if position >= len(self.df)]
+            visits = self.df.iloc[stored]
+            if not recent:
+                return visits
+            new = self.build_frame([self.pending[position - len(self.df)] for position in recent])
+            new.index = recent
+            new["MRN"] = mrn
+            combined = apply_schema(pd.concat([visits, new])) if stored else new
+            return combined.loc[positions]
+
+    # Patients matching an MRN prefix, date of birth and/or window of last
+    # radiotherapy, with the dates recorded for them and their number of visits
+    def search(self, text="", birth_date=None, radiotherapy_from=None, radiotherapy_to=None, limit=20):
+        with self.lock:
+            self.refresh()
+            mrns = self.patient_search.search(text, visit_sort_key(birth_date), visit_sort_key(radiotherapy_from),
+                                              visit_sort_key(radiotherapy_to), limit)
+            return [{
+                "MRN": mrn,
+                "Date_of_Birth": ", ".join(sorted(self.patient_search.patients[mrn][1])),
+                "Date_of_Last_Radiotherapy": ", ".join(sorted(self.patient_search.patients[mrn][2])),
+                "Last follow-up": self.mrn_index[mrn][-1][0],
+                "Visits": len(self.mrn_index[mrn]),
+            } for mrn in mrns]
+
+    # Every save of a patient, oldest first: when and by whom it was made and
+    # which values differ from the patient's save before it
+    def history(self, mrn):
+        with self.lock:
+            visits = self.visits(mrn)
+            saves = [(self.row_saved_at[position] or "", position, self.row_saved_by[position])
+                     for position in visits.index]
+        rows, previous = [], None
+        for saved_at, position, saved_by in sorted(saves, key=lambda save: save[:2]):
+            values = log_values(visits.loc[position].to_dict())
+            if previous is None:
+                changed = "First save"
+            else:
+                changed = ", ".join(key for key, value in values.items() if value != previous.get(key))
+            rows.append({"Saved at (UTC)": saved_at[:19].replace("T", " "), "Saved by": saved_by or "",
+                         "Follow_up_date": values["Follow_up_date"], "Changed": changed})
+            previous = values
+        return pd.DataFrame(rows, columns=["Saved at (UTC)", "Saved by", "Follow_up_date", "Changed"])
+
+    # Data-quality issues of every visit; only patients with visits added since
+    # the last audit are checked again
+    def quality_issues(self):
+        with self.lock:
+            df = self.frame()
+            return self.audit.run(df, self.generation, self.mrn_index)
+
+    # A save as the changes against the patient's latest visit, which the form
+    # was prefilled from: only the values that differ are written, with the entry
+    # id of that visit to complete them from. The first visit of a patient is
+    # written in full, and the Parquet snapshot keeps every row in full.
+    def delta(self, row):
+        with self.lock:
+            self.refresh()
+            visits = self.mrn_index.get(row["MRN"])
+            base_entry = self.row_entries[visits[-1][1]] if visits else None
+            if base_entry is None:
+                return row
+            base = log_values(self.row(visits[-1][1]))
+        values = log_values(row)
+        changes = {key: value for key, value in values.items()
+                   if key.startswith("_") or key == "MRN" or value != base.get(key)}
+        # Values the new row leaves out are cleared
+        changes.update({key: None for key, value in base.items()
+                        if key not in values and value is not None and not key.startswith("_")})
+        changes["_base"] = base_entry
+        with self.lock:
+            self.saved[row["_entry"]] = row
+        return changes
+
+    # Saving only appends to the log, then reads back everything written since
+    # the last refresh, including rows other servers appended in the meantime.
+    # In write-behind mode the row is journaled and written by the background writer.
+    def append(self, data, saved_by=None):
+        row = self.delta(new_entry(data, saved_by))
+        if self.writer:
+            self.writer.submit(row)
+            return
+        with self.file_lock:
+            self.log.append([row])
+        self.refresh()
+
+    # Number of saves not yet written to the share and the last write error
+    def write_status(self):
+        if not self.writer:
+            return 0, None
+        if not self.writer.alive():
+            return self.writer.pending(), "the background writer has stopped; restart the server to write the saves"
+        return self.writer.pending(), self.writer.error
+
+    # Bulk imports skip the write-behind queue and append each batch in one write
+    def append_many(self, rows):
+        rows = [new_entry(row) for row in rows]
+        with self.file_lock:
+            self.log.append(rows)
+        self.refresh()
+
+    # (MRN, follow-up date) of every visit in the registry
+    def visit_keys(self):
+        with self.lock:
+            self.refresh()
+            return {(mrn, key) for mrn, entries in self.mrn_index.items() for key, _ in entries}
+
+    # The frame is taken under the lock and written after releasing it, so
+    # lookups and saves in other sessions do not wait for the export
+    def export_workbook(self):
+        export_workbook(self.frame(), self.workbook_path)
+
+
+# One registry per server process, shared across sessions and reruns
+@st.cache_resource
+def get_registry():
+    metrics.start_exporter()
+    return Registry(registry_log, excel_file, journal_file if write_behind else None, registry_snapshot)
+
+# Load existing data or create a new DataFrame
+@metrics.timed("load_data_seconds")
+def load_data():
+    return get_registry().frame()
+
+# Function to identify the current registry contents for caching derived results
+def get_data_version():
+    return get_registry().version()
+
+# Function to fetch the most recent visit of a patient by MRN
+@metrics.timed("get_patient_data_seconds")
+def get_patient_data(mrn):
+    return get_registry().latest_visit(str(mrn).strip())
+
+# Function to fetch every visit of a patient by MRN, oldest first, optionally as
+# saved up to a past date and time
+def get_patient_visits(mrn, as_of=None):
+    return get_registry().visits(str(mrn).strip(), as_of)
+
+# Function to list every save of a patient with who made it and what changed
+def get_patient_history(mrn):
+    return get_registry().history(str(mrn).strip())
+
+# Function to load the registry as it was at a past date and time
+def load_data_as_of(timestamp):
+    return get_registry().as_of(timestamp)
+
+# Function to find patients by partial MRN, date of birth or radiotherapy dates
+@metrics.timed("search_patients_seconds")
+def search_patients(text="", birth_date=None, radiotherapy_from=None, radiotherapy_to=None, limit=20):
+    return get_registry().search(text, birth_date, radiotherapy_from, radiotherapy_to, limit)
+
+# Function to list the data-quality issues of the registry, one row per issue
+@metrics.timed("audit_seconds")
+def audit_data():
+    return get_registry().quality_issues()
+
+# Function to save patient data (Appending Instead of Overwriting)
+@metrics.timed("save_data_seconds")
+def save_data(data, saved_by=None):
+    data["MRN"] = str(data["MRN"]).strip()
+
+    # Append new data as a separate row instead of replacing the existing one
+    get_registry().append(data, saved_by)
+
+# Function to report saves waiting for the network share
+def get_write_status():
+    return get_registry().write_status()
+
+# Function to rebuild Breast_clinic.xlsx from the registry for the research team
+def export_data():
+    get_registry().export_workbook()
+
+
+# Function to read part of the registry straight from the share, without loading
+# all of it: only the snapshot partitions of the radiotherapy years asked for are
+# opened, MRNs are filtered inside the Parquet files, and the log lines written
+# since the snapshot are filtered the same way. With `as_of`, only the rows saved
+# up to then are returned. For scripts and scheduled jobs; the app works on the
+# registry it keeps in memory.
+def read_registry(radiotherapy_from=None, radiotherapy_to=None, mrns=None, as_of=None):
+    start = pd.Timestamp(radiotherapy_from) if radiotherapy_from else None
+    end = pd.Timestamp(radiotherapy_to) if radiotherapy_to else None
+    mrns = {str(mrn).strip() for mrn in mrns} if mrns is not None else None
+    snapshot, meta, offset = read_snapshot(registry_snapshot, start.year if start else None,
+                                           end.year if end else None, mrns)
+    log = RowLog(registry_log)
+    if offset > (log.signature() or (0, 0))[1]:
+        snapshot, meta, offset = None, {column: [] for column in ROW_METADATA}, 0
+    rows, _ = log.read(offset)
+    positions = {entry: position for position, entry in enumerate(meta["_entry"]) if entry is not None}
+    new = []
+    for row in rows:
+        entry = row.get("_entry")
+        if entry is not None:
+            if entry in positions:
+                continue
+            positions[entry] = None
+        row["MRN"] = str(row.get("MRN")).strip()
+        if mrns is None or row["MRN"] in mrns:
+            new.append(row)
+
+    # Saves are made against the same patient's latest visit, which can sit in a
+    # partition of another radiotherapy year than the ones read
+    missing = {row["MRN"] for row in new if row.get("_base") is not None and row["_base"] not in positions}
+    others, others_meta = None, {"_entry": []}
+    if missing and (start is not None or end is not None):
+        others, others_meta, _ = read_snapshot(registry_snapshot, mrns=missing)
+    other_positions = {entry: position for position, entry in enumerate(others_meta["_entry"])}
+    completed = {}
+    for index, row in enumerate(new):
+        if "_base" in row:
+            base = completed.get(row["_base"])
+            if base is None and positions.get(row["_base"]) is not None:
+                base = snapshot.iloc[positions[row["_base"]]].to_dict()
+            elif base is None and row["_base"] in other_positions:
+                base = others.iloc[other_positions[row["_base"]]].to_dict()
+            new[index] = row = complete_row(row, base)
+        if row.get("_entry") is not None:
+            completed[row["_entry"]] = row
+
+    saved_at = list(meta["_saved_at"]) + [row.get("_saved_at") for row in new]
+    df = Registry.build_frame(new)
+    if snapshot is not None:
+        df = Registry.concat(apply_schema(snapshot), df)
+    keep = np.ones(len(df), dtype=bool)
+    if as_of is not None:
+        keep &= np.array([value or "" for value in saved_at], dtype=object) <= saved_at_key(as_of)
+    if start is not None:
+        keep &= (df["Date_of_Last_Radiotherapy"] >= start).to_numpy()
+    if end is not None:
+        keep &= (df["Date_of_Last_Radiotherapy"] <= end).to_numpy()
+    return df[keep].reset_index(drop=True)
+
+# Scheduled export, e.g. from a nightly task: python registry.py. Only the server
+# process owns the write-behind journal, so the export reads the share directly
+# instead of starting a registry of its own.
+if __name__ == "__main__":
+    export_workbook(read_registry(), excel_file)
@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Columns of the registry, in the order they are written to the workbook
+COLUMNS = [
+    "MRN", "Date_of_Birth", "Age", "Date_of_Last_Radiotherapy", "Follow_up_date", "Follow_up_time",
+    "Histology", "Grade", "ER", "PR", "HER2", "Clinical Stage", "Pathological Stage", "Margins", "LVI", "Surgery", "Surgery_date",
+    "Neoadjuvant_hormonal_therapy", "Neoadjuvant_systemic_treatment", "Neoadjuvant_systemic_treatment_type",
+    "Adjuvant_systemic_treatment", "Adjuvant_systemic_treatment_type",
+    "Laterality", "Volume - Left Breast", "Volume - Right Breast", "Fractionation",
+    "Radiodermatitis", "Telangiectasia", "Breast_pain", "Cosmetic_outcome", "Breast_shrinkage", "Hyperpigmentation",
+    "Lymphedema", "Surgery_for_cosmetics",
+    "Breast_edema", "Breast_fibrosis", "Tumor_bed_fibrosis", "Tumor_bed_retraction",
+    "Pneumonitis", "Esophagitis", "Fatigue",
+    "Local_recurrence", "Local Recurrence Definition", "Time_to_local_recurrence", "Regional_recurrence", "Regional Recurrence Definition", "Time_to_regional_recurrence",
+    "Distant_recurrence", "Distant Recurrence Definition", "Time_to_distant_recurrence", "Cancer Related Death", "Death", "Time_to_death"
+]
+
+# Multiselect answers, stored as lists of strings
+LIST_COLUMNS = [
+    "Histology", "HER2", "Clinical Stage", "Pathological Stage", "Margins", "Surgery",
+    "Neoadjuvant_systemic_treatment_type", "Adjuvant_systemic_treatment_type", "Fractionation",
+    "Local Recurrence Definition", "Regional Recurrence Definition", "Distant Recurrence Definition",
+]
+
+# Dates, stored as datetime64
+DATE_COLUMNS = ["Date_of_Birth", "Date_of_Last_Radiotherapy", "Follow_up_date", "Surgery_date"]
+
+# Ages and times in months, stored as floats ("N/A" becomes missing)
+NUMBER_COLUMNS = [
+    "Age", "Follow_up_time", "Time_to_local_recurrence", "Time_to_regional_recurrence",
+    "Time_to_distant_recurrence", "Time_to_death",
+]
+
+# Toxicity grades and other ordinal scales, mildest first
+GRADES_4 = ["None", "I", "II", "III"]
+GRADES_5 = ["None", "I", "II", "III", "IV"]
+GRADES_6 = ["None", "I", "II", "III", "IV", "V"]
+ORDINAL_COLUMNS = {
+    "Grade": ["I", "II", "III"],
+    "Radiodermatitis": GRADES_5,
+    "Telangiectasia": GRADES_4,
+    "Hyperpigmentation": ["None", "I", "II"],
+    "Lymphedema": GRADES_4,
+    "Breast_pain": GRADES_4,
+    "Breast_edema": GRADES_4,
+    "Breast_fibrosis": GRADES_4,
+    "Tumor_bed_fibrosis": GRADES_4,
+    "Pneumonitis": GRADES_6,
+    "Esophagitis": GRADES_6,
+    "Fatigue": GRADES_4,
+    "Cosmetic_outcome": ["Excellent", "Good", "Fair", "Poor"],
+}
+
+# Single-choice answers without an order
+NO_YES = ["No", "Yes"]
+VOLUMES = ["Whole Breast", "Partial Breast", "Locorregional Breast", "Chest wall", "Locorregional chest wall", "Not treated"]
+CHOICE_COLUMNS = {
+    "ER": ["Negative", "Positive"],
+    "PR": ["Negative", "Positive"],
+    "LVI": ["Negative", "Positive", "Unknown"],
+    "Laterality": ["Left", "Right", "Bilateral"],
+    "Volume - Left Breast": VOLUMES,
+    "Volume - Right Breast": VOLUMES,
+    "Neoadjuvant_hormonal_therapy": NO_YES,
+    "Breast_shrinkage": NO_YES,
+    "Tumor_bed_retraction": NO_YES,
+    "Surgery_for_cosmetics": NO_YES,
+    "Local_recurrence": NO_YES,
+    "Regional_recurrence": NO_YES,
+    "Distant_recurrence": NO_YES,
+    "Cancer Related Death": NO_YES,
+    "Death": NO_YES,
+}
+
+# Options offered by the form's multiselects
+SYSTEMIC_TREATMENTS = ["None", "Chemotherapy", "CDK4/6 inhibitors", "Endocrine therapy", "Immunotherapy", "ADC", "Targeted Therapy", "PARP inhibitors", "Radioligand", "Other"]
+LIST_OPTIONS = {
+    "Histology": ["IDC", "ILC", "DCIS", "LCIS", "Other"],
+    "HER2": ["Negative", "FISH Positive", "1+", "2+", "3+", "FISH Negative", "Other"],
+    "Clinical Stage": ["cTx", "cTis", "cT1a", "cT1b", "cT1c", "cT2", "cT3", "cT4a", "cT4b", "cT4c", "cT4d", "cN0", "cN1a", "cN1b", "cN1c", "cN2a", "cN2b", "cN3a", "cN3b", "cN3c", "M0", "M1"],
+    "Pathological Stage": ["pTx", "pTis", "pT1a", "pT1b", "pT1c", "pT2", "pT3", "pT4a", "pT4b", "pT4c", "pT4d", "pN0", "pN1a", "pN1b", "pN1c", "pN2a", "pN2b", "pN3a", "pN3b", "pN3c", "M0", "M1"],
+    "Margins": ["Negative", "Positive", "<1mm", "1mm", "2mm", ">2mm", "Other"],
+    "Surgery": ["Total Mastectomy", "Partial Mastectomy", "Skin sparing mastectomy", "Nipple sparing mastectomy", "Lumpectomy", "SLNB", "ALND", "Targeted axillary dissection", "Other"],
+    "Neoadjuvant_systemic_treatment_type": SYSTEMIC_TREATMENTS,
+    "Adjuvant_systemic_treatment_type": SYSTEMIC_TREATMENTS,
+    "Fractionation": ["26Gy", "30Gy SIB", "27Gy SIB", "28Gy SIB", "31Gy SIB", "40Gy", "10Gy sequential boost", "5.2Gy sequential boost", "27.5Gy/28.5Gy weekly", "Other"],
+    "Local Recurrence Definition": ["Tumor Bed Recurrence", "Another Quadrant", "Same Quadrant", "Chest wall"],
+    "Regional Recurrence Definition": ["Axillary", "Supraclavicular", "Internal mammary"],
+    "Distant Recurrence Definition": ["Bone", "Liver", "Lung", "Brain", "Other"],
+}
+
+LIST_DTYPE = pd.ArrowDtype(pa.list_(pa.string()))
+
+
+# Parse a multiselect answer: a list, or the list repr older rows hold in Excel cells
+def parse_list(value):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [str(item) for item in value]
+    if not isinstance(value, str):
+        return []
+    return [item.strip() for item in value.replace("[", "").replace("]", "").replace("'", "").split(",") if item]
+
+
+def to_text(series):
+    series = series.astype(object)
+    return series.where(series.isna(), series.astype(str))
+
+
+# Values outside the known options are kept as extra categories rather than lost
+def to_categorical(series, categories, ordered):
+    values = to_text(series)
+    extra = sorted(set(values.dropna()) - set(categories))
+    return pd.Categorical(values, categories=categories + extra, ordered=ordered)
+
+
+# Convert the registry columns to their stored types. Columns that already have
+# the right type are left alone, so this is cheap to repeat after appending rows.
+def apply_schema(df):
+    for column in df.columns:
+        dtype = df[column].dtype
+        if column in LIST_COLUMNS:
+            if dtype != LIST_DTYPE:
+                values = [[] if isinstance(value, str) and value == "N/A" else parse_list(value) for value in df[column]]
+                df[column] = pd.array(values, dtype=LIST_DTYPE)
+        elif column in DATE_COLUMNS:
+            if not pd.api.types.is_datetime64_dtype(dtype):
+                df[column] = pd.to_datetime(df[column], errors="coerce", format="mixed")
+        elif column in NUMBER_COLUMNS:
+            if not pd.api.types.is_float_dtype(dtype):
+                df[column] = pd.to_numeric(df[column], errors="coerce").astype(float)
+        elif column in ORDINAL_COLUMNS or column in CHOICE_COLUMNS:
+            if not isinstance(dtype, pd.CategoricalDtype):
+                ordered = column in ORDINAL_COLUMNS
+                categories = ORDINAL_COLUMNS[column] if ordered else CHOICE_COLUMNS[column]
+                df[column] = to_categorical(df[column], categories, ordered)
+        elif dtype == object:
+            df[column] = to_text(df[column])
+    return df
@@ -0,0 +1,101 @@
+import re
+from bisect import bisect_left, insort
+
+import numpy as np
+import pandas as pd
+
+
+# MRNs are typed with or without spaces and dashes, in upper or lower case
+def normalize_mrn(mrn):
+    return re.sub(r"[^0-9A-Z]", "", str(mrn).upper())
+
+
+# ISO date strings of a date column, "" where the date is missing
+def date_keys(series):
+    days = pd.to_datetime(series, errors="coerce").to_numpy().astype("datetime64[D]")
+    keys = np.datetime_as_string(days, unit="D").astype(object)
+    keys[np.isnat(days)] = ""
+    return keys
+
+
+# Patient search over the whole registry. Normalized MRNs are kept sorted, so
+# every MRN starting with what was typed is one contiguous range found by
+# bisection; dates of birth and of last radiotherapy are kept as sorted
+# (ISO date, MRN) pairs the same way. Dates are indexed as recorded at any visit.
+class PatientSearch:
+    def __init__(self):
+        self.mrns = []
+        self.birth_dates = []
+        self.radiotherapy_dates = []
+        # MRN -> [normalized MRN, dates of birth, dates of last radiotherapy]
+        self.patients = {}
+
+    @classmethod
+    def build(cls, df):
+        index = cls()
+        keys = pd.DataFrame({
+            "MRN": df["MRN"].to_numpy(),
+            "birth": df["Date_of_Birth"].to_numpy(),
+            "radiotherapy": df["Date_of_Last_Radiotherapy"].to_numpy(),
+        }).drop_duplicates()
+        mrns = keys["MRN"].drop_duplicates()
+        normalized = mrns.str.upper().str.replace(r"[^0-9A-Z]", "", regex=True)
+        index.patients = {mrn: [key, set(), set()] for mrn, key in zip(mrns, normalized)}
+        index.mrns = sorted(zip(normalized, mrns))
+        for column, pairs, slot in (("birth", index.birth_dates, 1), ("radiotherapy", index.radiotherapy_dates, 2)):
+            dates = keys[[column, "MRN"]].drop_duplicates()
+            dates = dates.assign(**{column: date_keys(dates[column])})
+            dates = dates[dates[column] != ""].sort_values([column, "MRN"])
+            for date, mrn in zip(dates[column], dates["MRN"]):
+                index.patients[mrn][slot].add(date)
+            pairs.extend(zip(dates[column], dates["MRN"]))
+        return index
+
+    # Index a newly saved visit; the dates are ISO strings or "" when missing
+    def add(self, mrn, birth_date, radiotherapy_date):
+        patient = self.patients.get(mrn)
+        if patient is None:
+            patient = self.patients[mrn] = [normalize_mrn(mrn), set(), set()]
+            insort(self.mrns, (patient[0], mrn))
+        for date, pairs, dates in ((birth_date, self.birth_dates, patient[1]),
+                                   (radiotherapy_date, self.radiotherapy_dates, patient[2])):
+            if date and date not in dates:
+                dates.add(date)
+                insort(pairs, (date, mrn))
+
+    def matches(self, mrn, prefix, birth_date, radiotherapy_from, radiotherapy_to):
+        normalized, birth_dates, radiotherapy_dates = self.patients[mrn]
+        if prefix and not normalized.startswith(prefix):
+            return False
+        if birth_date and birth_date not in birth_dates:
+            return False
+        if radiotherapy_from or radiotherapy_to:
+            return any((not radiotherapy_from or date >= radiotherapy_from) and
+                       (not radiotherapy_to or date <= radiotherapy_to) for date in radiotherapy_dates)
+        return True
+
+    # MRNs of up to `limit` patients matching every criterion given. Only the
+    # narrowest index range is walked, checking the other criteria on the way.
+    def search(self, text="", birth_date="", radiotherapy_from="", radiotherapy_to="", limit=20):
+        prefix = normalize_mrn(text)
+        ranges = []
+        if prefix:
+            # "\uffff" sorts after every character an MRN can hold
+            ranges.append((self.mrns, bisect_left(self.mrns, (prefix,)), bisect_left(self.mrns, (prefix + "\uffff",))))
+        if birth_date:
+            ranges.append((self.birth_dates, bisect_left(self.birth_dates, (birth_date,)),
+                           bisect_left(self.birth_dates, (birth_date + "\uffff",))))
+        if radiotherapy_from or radiotherapy_to:
+            ranges.append((self.radiotherapy_dates, bisect_left(self.radiotherapy_dates, (radiotherapy_from,)),
+                           bisect_left(self.radiotherapy_dates, ((radiotherapy_to or "9999-12-31") + "\uffff",))))
+        if not ranges:
+            return []
+        pairs, start, stop = min(ranges, key=lambda bounds: bounds[2] - bounds[1])
+        found = []
+        for position in range(start, stop):
+            mrn = pairs[position][1]
+            if mrn not in found and self.matches(mrn, prefix, birth_date, radiotherapy_from, radiotherapy_to):
+                found.append(mrn)
+                if len(found) == limit:
+                    break
+        return found
@@ -0,0 +1,339 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timezone
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import metrics
+
+# Append-only row log: every saved follow-up is one JSON object on its own line.
+# Saving only appends a line, so its cost does not depend on the registry size,
+# and a crash can at worst leave a torn last line that readers skip.
+class RowLog:
+    # Reads and appends are timed under `name`, if given (see metrics.METRICS)
+    def __init__(self, path, name=None):
+        self.path = path
+        self.name = name
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    # Modification time and size of the log, None if it does not exist yet
+    def signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    # Read the complete lines written after `offset`; returns the rows and the
+    # offset to continue from. An unfinished last line is left for the next read.
+    def read(self, offset=0):
+        if not self.exists():
+            return [], 0
+        start = time.perf_counter()
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        rows = []
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                # Torn line left behind by an interrupted write
+                continue
+        if self.name:
+            metrics.observe(self.name + "_read_seconds", time.perf_counter() - start)
+            metrics.observe(self.name + "_read_bytes", len(data))
+        return rows, offset + end
+
+    def append(self, rows):
+        payload = "".join(json.dumps(row, default=str) + "\n" for row in rows).encode("utf-8")
+        started = time.perf_counter()
+        with open(self.path, "ab+") as f:
+            # Start on a fresh line if a previous write was interrupted
+            start = f.tell()
+            if start > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    payload = b"\n" + payload
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        if self.name:
+            metrics.observe(self.name + "_append_seconds", time.perf_counter() - started)
+            metrics.observe(self.name + "_append_bytes", len(payload))
+        # Somebody appended without holding the lock and the lines may be
+        # interleaved; the caller retries and readers drop the duplicates
+        if os.path.getsize(self.path) != start + len(payload):
+            raise ConcurrentModificationError(f"{self.path} was modified while it was being written")
+
+    def truncate(self):
+        with open(self.path, "wb") as f:
+            os.fsync(f.fileno())
+
+
+class ConcurrentModificationError(Exception):
+    pass
+
+
+class LockTimeoutError(Exception):
+    pass
+
+
+# Lock file next to the registry log, so that servers sharing the network drive
+# append one at a time. Creating it with O_EXCL is atomic on SMB shares as well
+# as local disks; a lock older than `stale_after` seconds was left by a crashed
+# writer and is broken.
+class FileLock:
+    def __init__(self, path, timeout=10, stale_after=60):
+        self.path = path
+        self.timeout = timeout
+        self.stale_after = stale_after
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                self.break_stale()
+                if time.monotonic() > deadline:
+                    raise LockTimeoutError(f"Timed out waiting for {self.path}")
+                time.sleep(0.05)
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(f"{socket.gethostname()} {os.getpid()}\n")
+            return
+
+    def break_stale(self):
+        try:
+            age = time.time() - os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return
+        if age > self.stale_after:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def release(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+# Save times are kept as UTC ISO strings, which sort chronologically; times
+# without a time zone are taken as local time
+def saved_at_key(timestamp):
+    return pd.Timestamp(timestamp).to_pydatetime().astimezone(timezone.utc).isoformat(timespec="milliseconds")
+
+
+# Tag a row with a unique id so a retried write can be recognised by readers,
+# and with when and by whom it was saved
+def new_entry(row, saved_by=None):
+    entry = dict(row, _entry=uuid.uuid4().hex, _saved_at=saved_at_key(pd.Timestamp.now(tz=timezone.utc)))
+    if saved_by:
+        entry["_saved_by"] = saved_by
+    return entry
+
+
+# Write-behind saving: a save is fsync'd to a journal on the local disk and
+# returns straight away; a background thread appends queued rows to the log on
+# the share in batches, under the file lock, retrying until the write succeeds.
+# Rows still in the journal when the server stops are written on the next start.
+class WriteBehind:
+    def __init__(self, log, lock, journal_path, on_written, batch_size=200, retry_delay=2):
+        self.log = log
+        self.lock = lock
+        self.journal = RowLog(journal_path, "journal")
+        self.on_written = on_written
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.condition = threading.Condition()
+        self.queued = []
+        self.error = None
+        self.thread = None
+
+    # Queue rows left in the journal whose entry id has not reached the log
+    def recover(self, written_entries):
+        entries, _ = self.journal.read()
+        done = {entry["done"] for entry in entries if "done" in entry}
+        with self.condition:
+            for entry in entries:
+                row = entry.get("row")
+                if row and row["_entry"] not in done and row["_entry"] not in written_entries:
+                    self.queued.append(row)
+            self.condition.notify()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="registry-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, row):
+        with self.condition:
+            self.journal.append([{"row": row}])
+            self.queued.append(row)
+            self.condition.notify()
+
+    def pending(self):
+        with self.condition:
+            return len(self.queued)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queued:
+                    self.condition.wait()
+                batch = self.queued[:self.batch_size]
+            try:
+                with self.lock:
+                    self.log.append(batch)
+                with self.condition:
+                    self.journal.append([{"done": row["_entry"]} for row in batch])
+            except Exception as error:
+                self.error = f"{type(error).__name__}: {error}"
+                time.sleep(self.retry_delay)
+                continue
+            with self.condition:
+                del self.queued[:len(batch)]
+                self.error = None
+            # The rows are on the share now; a failure to tidy the journal or read
+            # them back is reported and left to the next write or refresh, and
+            # must not stop the thread
+            try:
+                with self.condition:
+                    if not self.queued:
+                        self.journal.truncate()
+                self.on_written()
+            except Exception as error:
+                self.error = f"{type(error).__name__}: {error}"
+
+    def alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+# Rebuild the Excel workbook from the registry for the research team. The file
+# is written next to the target and swapped in, so readers never see half of it.
+def export_workbook(df, path):
+    base, extension = os.path.splitext(path)
+    tmp_path = base + ".tmp" + extension
+    start = time.perf_counter()
+    df.to_excel(tmp_path, index=False)
+    metrics.observe("workbook_write_seconds", time.perf_counter() - start)
+    metrics.observe("workbook_write_bytes", os.path.getsize(tmp_path))
+    os.replace(tmp_path, path)
+
+
+# Typed snapshot of the registry in Parquet, partitioned by year of last
+# radiotherapy in the Hive layout (radiotherapy_year=2021/part.parquet), so that
+# pyarrow, pandas or R can read it as one dataset and skip the years they do not
+# need. _manifest.json records how far into the row log the snapshot goes;
+# loading reads the snapshot (memory-mapped, no parsing) plus the log lines
+# written after it.
+MANIFEST = "_manifest.json"
+# Partition of the rows without a radiotherapy date, named the way Hive does
+MISSING_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+# Columns stored next to every row of the snapshot (see new_entry)
+ROW_METADATA = ["_entry", "_saved_at", "_saved_by"]
+
+
+def partition_names(radiotherapy_dates):
+    years = pd.to_datetime(radiotherapy_dates, errors="coerce").dt.year.astype("Int64")
+    return ("radiotherapy_year=" + years.astype(str)).where(years.notna(), "radiotherapy_year=" + MISSING_PARTITION)
+
+
+def partition_year(name):
+    value = name.split("=", 1)[1]
+    return None if value == MISSING_PARTITION else int(value)
+
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# Only the partitions from `first_year` to `last_year` are opened when either is
+# given (rows without a radiotherapy date are then left out), and only the rows
+# of `mrns` are read from them when given. Returns the rows, their ROW_METADATA
+# values by column and the log offset the snapshot goes up to.
+def read_snapshot(path, first_year=None, last_year=None, mrns=None):
+    manifest = read_manifest(path)
+    if manifest is None:
+        return None, {column: [] for column in ROW_METADATA}, 0
+    tables = []
+    for name in sorted(manifest["partitions"]):
+        if first_year is not None or last_year is not None:
+            year = partition_year(name)
+            if year is None or (first_year is not None and year < first_year) or (last_year is not None and year > last_year):
+                continue
+        part = os.path.join(path, name, "part.parquet")
+        if mrns is None:
+            # Read the file directly; read_table sets up a dataset for every file,
+            # which costs more than the read itself for small partitions
+            with pq.ParquetFile(part, memory_map=True) as parquet_file:
+                tables.append(parquet_file.read())
+        else:
+            tables.append(pq.read_table(part, memory_map=True, filters=[("MRN", "in", list(mrns))]))
+    if not tables:
+        return pd.DataFrame(), {column: [] for column in ROW_METADATA}, manifest["log_offset"]
+    # Columns left empty in one partition are stored as nulls and take the type
+    # they have in the others
+    table = pa.concat_tables(tables, promote_options="permissive")
+    # Snapshots taken before save times were recorded only hold the entry ids
+    meta = {column: table.column(column).to_pylist() if column in table.column_names else [None] * len(table)
+            for column in ROW_METADATA}
+    df = table.drop_columns([column for column in ROW_METADATA if column in table.column_names]).to_pandas(
+        types_mapper=lambda arrow_type: pd.ArrowDtype(arrow_type) if pa.types.is_list(arrow_type) else None
+    )
+    return df, meta, manifest["log_offset"]
+
+
+# Rewrite the partitions named in `changed` from the registry frame, given the
+# partition of every row and its ROW_METADATA values; the other partitions gained no rows since the last
+# snapshot and are left alone. Only moves the snapshot further into the log.
+def write_snapshot(df, meta, offset, path, partitions, changed):
+    manifest = read_manifest(path) or {"log_offset": 0, "partitions": {}}
+    if manifest["partitions"] and manifest["log_offset"] >= offset:
+        return
+    meta = {column: np.asarray(values, dtype=object) for column, values in meta.items()}
+    codes, names = pd.factorize(np.asarray(partitions))
+    for code, name in enumerate(names):
+        if name not in changed:
+            continue
+        rows = np.flatnonzero(codes == code)
+        directory = os.path.join(path, name)
+        os.makedirs(directory, exist_ok=True)
+        table = pa.Table.from_pandas(df.iloc[rows].assign(**{column: values[rows] for column, values in meta.items()}), preserve_index=False)
+        tmp_path = os.path.join(directory, "part.parquet.tmp")
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, os.path.join(directory, "part.parquet"))
+        manifest["partitions"][name] = len(rows)
+    # Written last: a partition rewritten before a crash only holds rows the
+    # log lines after the old offset hold as well, and readers drop the repeats
+    manifest["log_offset"] = offset
+    tmp_path = os.path.join(path, MANIFEST + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(path, MANIFEST))